@@ -0,0 +1,4 @@
+# Benchmarks for mygit on synthetic repositories of different sizes
+#   python3 -m bench generate <dir> [--size NAME] [--files N] ...
+#   python3 -m bench run [--size NAME]... [--repeat N] [--output FILE]
+#   python3 -m bench compare <old.json> <new.json> [--threshold FRACTION]
@@ -0,0 +1,89 @@
+import argparse
+import json
+import sys
+import tempfile
+
+from bench.generate import SIZES, generate
+from bench.run import BENCHMARKS, run_benchmarks
+from bench.compare import load_report, compare_reports, print_comparison
+
+PARAMS = ["files", "file_size", "commits", "branches", "merge_every"]
+
+
+def add_size_options(parser):
+    parser.add_argument("--files", type=int, help="number of files")
+    parser.add_argument("--file-size", type=int, help="bytes in each file")
+    parser.add_argument("--commits", type=int, help="number of commits, not counting merges")
+    parser.add_argument("--branches", type=int, help="number of branches besides trunk")
+    parser.add_argument("--merge-every", type=int, help="merge a branch into trunk after every n-th commit, 0 for never")
+
+
+# The named sizes, with any size options given applied to all of them
+def chosen_sizes(names, options):
+    overrides = {name: getattr(options, name) for name in PARAMS if getattr(options, name) is not None}
+    sizes = {}
+    for name in names:
+        if name not in SIZES:
+            sys.exit(f"bench: error: unknown size '{name}', expected one of {', '.join(SIZES)}")
+        sizes[name] = dict(SIZES[name], **overrides)
+    return sizes
+
+
+def main():
+    parser = argparse.ArgumentParser(prog="python3 -m bench")
+    commands = parser.add_subparsers(dest="action", required=True)
+
+    generate_parser = commands.add_parser("generate", help="generate a synthetic repository")
+    generate_parser.add_argument("path")
+    generate_parser.add_argument("--size", default="small", help="preset to start from: " + ", ".join(SIZES))
+    generate_parser.add_argument("--seed", type=int, default=0)
+    add_size_options(generate_parser)
+
+    run_parser = commands.add_parser("run", help="time every command and write a JSON report")
+    run_parser.add_argument("--size", action="append", help="preset to run, can be repeated (default: small and medium)")
+    run_parser.add_argument("--repeat", type=int, default=5, help="times to run each command")
+    run_parser.add_argument("--command", action="append", choices=[name for name, _ in BENCHMARKS],
+                            help="only time this command, can be repeated")
+    run_parser.add_argument("--output", help="file to write the report to (default: stdout)")
+    run_parser.add_argument("--workdir", help="where to generate repositories (default: a temporary directory)")
+    add_size_options(run_parser)
+
+    compare_parser = commands.add_parser("compare", help="compare two reports and flag regressions")
+    compare_parser.add_argument("old")
+    compare_parser.add_argument("new")
+    compare_parser.add_argument("--threshold", type=float, default=0.10,
+                                help="slowdown that counts as a regression, as a fraction (default: 0.10)")
+    compare_parser.add_argument("--min-delta", type=float, default=0.005,
+                                help="smallest slowdown in seconds that counts (default: 0.005)")
+
+    options = parser.parse_args()
+
+    if options.action == "generate":
+        params = chosen_sizes([options.size], options)[options.size]
+        repo = generate(options.path, seed=options.seed, **params)
+        repo.close()
+        print(f"Generated {options.size} repository in {options.path}")
+        return 0
+
+    if options.action == "run":
+        sizes = chosen_sizes(options.size or ["small", "medium"], options)
+        if options.workdir:
+            report = run_benchmarks(sizes, options.repeat, options.workdir, options.command)
+        else:
+            with tempfile.TemporaryDirectory(prefix="mygit-bench-") as workdir:
+                report = run_benchmarks(sizes, options.repeat, workdir, options.command)
+        if options.output:
+            with open(options.output, "w") as file:
+                json.dump(report, file, indent=4)
+        else:
+            json.dump(report, sys.stdout, indent=4)
+            print()
+        return 0
+
+    rows = compare_reports(load_report(options.old), load_report(options.new), options.threshold, options.min_delta)
+    print_comparison(rows)
+    # Exit with 1 if anything regressed, so scripts can fail on it
+    return 1 if any(row[-1] for row in rows) else 0
+
+
+sys.exit(main())
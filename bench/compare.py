@@ -0,0 +1,42 @@
+# Compare two benchmark reports and flag the commands that got slower
+
+import json
+
+
+def load_report(path):
+    with open(path, "r") as file:
+        return json.load(file)
+
+
+# A command has regressed when its median time went up by more than
+# threshold (a fraction) and by more than min_delta seconds, so noise on
+# commands that only take a few milliseconds isn't flagged
+# Returns rows of (size, command, old median, new median, regressed),
+# with None for a median missing from one of the reports
+def compare_reports(old, new, threshold=0.10, min_delta=0.005):
+    old_medians = {(result["size"], result["command"]): result["median"] for result in old["results"]}
+    new_medians = {(result["size"], result["command"]): result["median"] for result in new["results"]}
+    rows = []
+    for key in list(old_medians) + [key for key in new_medians if key not in old_medians]:
+        before = old_medians.get(key)
+        after = new_medians.get(key)
+        regressed = (
+            before is not None and after is not None
+            and after > before * (1 + threshold) and after - before > min_delta
+        )
+        rows.append((*key, before, after, regressed))
+    return rows
+
+
+def print_comparison(rows):
+    for size, command, before, after, regressed in rows:
+        if before is None or after is None:
+            change = "only in " + ("new" if before is None else "old")
+            before_text = "-" if before is None else f"{before * 1000:.1f} ms"
+            after_text = "-" if after is None else f"{after * 1000:.1f} ms"
+        else:
+            change = f"{(after - before) / before:+.1%}" if before else "-"
+            before_text = f"{before * 1000:.1f} ms"
+            after_text = f"{after * 1000:.1f} ms"
+        flag = "  REGRESSION" if regressed else ""
+        print(f"{size:8} {command:10} {before_text:>12} {after_text:>12} {change:>10}{flag}")
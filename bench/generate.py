@@ -0,0 +1,110 @@
+# Build synthetic repositories of a chosen size for the benchmarks
+# The repository is built through one `mygit batch` process, so building
+# a big history doesn't pay for starting Python for every command
+
+import os
+import random
+import shlex
+import subprocess
+import sys
+
+root_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# From a toy repository up to one about the size of a real project
+SIZES = {
+    "small": {"files": 100, "file_size": 1024, "commits": 20, "branches": 2, "merge_every": 5},
+    "medium": {"files": 2000, "file_size": 4096, "commits": 100, "branches": 4, "merge_every": 10},
+    "large": {"files": 20000, "file_size": 4096, "commits": 300, "branches": 8, "merge_every": 20},
+}
+
+# Files changed by each generated commit
+CHANGES_PER_COMMIT = 3
+
+# Filenames given to one add command
+ADD_BATCH = 500
+
+
+class Repo:
+    # A repository driven through one `mygit batch` process
+    def __init__(self, path):
+        self.path = path
+        self.process = subprocess.Popen(
+            [sys.executable, os.path.join(root_dir, "mygit.py"), "batch"],
+            cwd=path, stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+            stderr=subprocess.STDOUT, text=True
+        )
+
+    # Run one command, returning its exit status and everything it printed
+    def run(self, *args):
+        self.process.stdin.write(shlex.join(args) + "\n")
+        self.process.stdin.flush()
+        output = []
+        for line in self.process.stdout:
+            if line.startswith("\0"):
+                return int(line[1:]), "".join(output)
+            output.append(line)
+        raise RuntimeError("mygit batch exited early")
+
+    # Run one command that has to succeed
+    def must(self, *args):
+        status, output = self.run(*args)
+        if status != 0:
+            raise RuntimeError(f"mygit {shlex.join(args)} failed: {output.strip()}")
+        return output
+
+    def write_file(self, name, size, rng):
+        # Text in 64 character lines, so the line-based deltas have lines to work with
+        text = rng.randbytes((size + 1) // 2).hex()[:size]
+        with open(os.path.join(self.path, name), "w") as file:
+            for start in range(0, len(text), 64):
+                file.write(text[start:start + 64] + "\n")
+
+    def close(self):
+        self.process.stdin.close()
+        self.process.wait()
+
+
+# Generate a repository at path, and return it still open
+# Every branch changes its own share of the files, so merges never
+# conflict. Every merge_every-th commit on a branch other than trunk is
+# followed by merging that branch into trunk, or never if it's 0
+def generate(path, files, file_size, commits, branches, merge_every, seed=0):
+    if files < branches + 1:
+        raise ValueError("need at least one file for each branch and trunk")
+    rng = random.Random(seed)
+    os.makedirs(path)
+    repo = Repo(path)
+    repo.must("init")
+
+    repo.files = [f"file{i:06d}" for i in range(files)]
+    for name in repo.files:
+        repo.write_file(name, file_size, rng)
+    for start in range(0, files, ADD_BATCH):
+        repo.must("add", *repo.files[start:start + ADD_BATCH])
+    repo.must("commit", "-m", "initial")
+
+    lanes = ["trunk"] + [f"branch{i}" for i in range(1, branches + 1)]
+    for branch in lanes[1:]:
+        repo.must("branch", branch)
+
+    current = "trunk"
+    for number in range(1, commits):
+        lane = number % len(lanes)
+        branch = lanes[lane]
+        if branch != current:
+            repo.must("checkout", branch)
+            current = branch
+        own_files = repo.files[lane::len(lanes)]
+        for name in rng.sample(own_files, min(CHANGES_PER_COMMIT, len(own_files))):
+            repo.write_file(name, file_size, rng)
+        repo.must("commit", "-a", "-m", f"commit {number}")
+
+        if branch != "trunk" and merge_every and number % merge_every == 0:
+            repo.must("checkout", "trunk")
+            current = "trunk"
+            repo.must("merge", branch, "-m", f"merge {branch}")
+
+    if current != "trunk":
+        repo.must("checkout", "trunk")
+    repo.file_size = file_size
+    return repo
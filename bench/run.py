@@ -0,0 +1,166 @@
+# Time each mygit command on generated repositories
+# Every timed command is run as its own process, the way it's normally
+# used, and anything it needs set up first is done outside the timing
+
+import datetime
+import os
+import platform
+import random
+import statistics
+import subprocess
+import sys
+import time
+
+from bench.generate import root_dir, generate
+
+# Files changed before each add, commit and commit -a
+CHANGED_FILES = 10
+
+REPORT_FORMAT = 1
+
+
+def time_command(repo, args):
+    script = os.path.join(root_dir, f"mygit-{args[0]}.py")
+    start = time.perf_counter()
+    result = subprocess.run(
+        [sys.executable, script, *args[1:]], cwd=repo.path,
+        stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, text=True
+    )
+    elapsed = time.perf_counter() - start
+    if result.returncode != 0:
+        raise RuntimeError(f"mygit {' '.join(args)} failed: {result.stderr.strip()}")
+    return elapsed
+
+
+# Each benchmark gets the repository and the number of the run, does any
+# setup it needs, and returns the arguments of the command to time
+def change_files(repo, rng):
+    names = rng.sample(repo.files, CHANGED_FILES)
+    for name in names:
+        repo.write_file(name, repo.file_size, rng)
+    return names
+
+
+def bench_add(repo, run, rng):
+    return ["add", *change_files(repo, rng)]
+
+
+def bench_commit(repo, run, rng):
+    repo.must("add", *change_files(repo, rng))
+    return ["commit", "-m", f"bench commit {run}"]
+
+
+def bench_commit_all(repo, run, rng):
+    change_files(repo, rng)
+    return ["commit", "-a", "-m", f"bench commit -a {run}"]
+
+
+def bench_status(repo, run, rng):
+    return ["status"]
+
+
+def bench_log(repo, run, rng):
+    return ["log"]
+
+
+def bench_show(repo, run, rng):
+    last_commit = repo.must("log", "-n", "1").split()[0]
+    return ["show", f"{last_commit}:{rng.choice(repo.files)}"]
+
+
+def bench_branch_delete(repo, run, rng):
+    repo.must("branch", f"bench-delete{run}")
+    return ["branch", "-d", f"bench-delete{run}"]
+
+
+# Switches to a branch with a few files changed and back again
+def bench_checkout(repo, run, rng):
+    if run == 0:
+        repo.must("branch", "bench-checkout")
+        repo.must("checkout", "bench-checkout")
+        change_files(repo, rng)
+        repo.must("commit", "-a", "-m", "bench checkout")
+        repo.must("checkout", "trunk")
+    return ["checkout", "bench-checkout" if run % 2 == 0 else "trunk"]
+
+
+# A real merge, with a change on each side
+def bench_merge(repo, run, rng):
+    branch_file, trunk_file = rng.sample(repo.files, 2)
+    repo.must("branch", f"bench-merge{run}")
+    repo.must("checkout", f"bench-merge{run}")
+    repo.write_file(branch_file, repo.file_size, rng)
+    repo.must("commit", "-a", "-m", f"bench merge branch {run}")
+    repo.must("checkout", "trunk")
+    repo.write_file(trunk_file, repo.file_size, rng)
+    repo.must("commit", "-a", "-m", f"bench merge trunk {run}")
+    return ["merge", f"bench-merge{run}", "-m", f"bench merge {run}"]
+
+
+def bench_rm(repo, run, rng):
+    name = f"bench-rm{run}"
+    repo.write_file(name, repo.file_size, rng)
+    repo.must("add", name)
+    repo.must("commit", "-m", f"bench rm {run}")
+    return ["rm", name]
+
+
+BENCHMARKS = [
+    ("add", bench_add),
+    ("commit", bench_commit),
+    ("commit -a", bench_commit_all),
+    ("status", bench_status),
+    ("log", bench_log),
+    ("show", bench_show),
+    ("branch -d", bench_branch_delete),
+    ("checkout", bench_checkout),
+    ("merge", bench_merge),
+    ("rm", bench_rm),
+]
+
+
+# Generate a repository with the given parameters and time every command on it
+def bench_size(size, params, repeat, workdir, commands=None):
+    print(f"generating {size} repository", file=sys.stderr)
+    start = time.perf_counter()
+    repo = generate(os.path.join(workdir, size), **params)
+    generate_seconds = time.perf_counter() - start
+
+    results = []
+    rng = random.Random(1)
+    try:
+        for command, bench in BENCHMARKS:
+            if commands and command not in commands:
+                continue
+            seconds = [time_command(repo, bench(repo, run, rng)) for run in range(repeat)]
+            # The checkout benchmark can finish on the other branch
+            if command == "checkout" and repeat % 2:
+                repo.must("checkout", "trunk")
+            results.append({
+                "size": size,
+                "command": command,
+                "seconds": seconds,
+                "min": min(seconds),
+                "median": statistics.median(seconds),
+            })
+            print(f"{size:8} {command:10} {results[-1]['median'] * 1000:9.1f} ms", file=sys.stderr)
+    finally:
+        repo.close()
+    return results, generate_seconds
+
+
+def run_benchmarks(sizes, repeat, workdir, commands=None):
+    report = {
+        "format": REPORT_FORMAT,
+        "created": datetime.datetime.now().isoformat(timespec='seconds'),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "repeat": repeat,
+        "sizes": {},
+        "results": [],
+    }
+    for size, params in sizes.items():
+        results, generate_seconds = bench_size(size, params, repeat, workdir, commands)
+        report["sizes"][size] = dict(params, generate_seconds=generate_seconds)
+        report["results"].extend(results)
+    return report
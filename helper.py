@@ -1,16 +1,541 @@
 #!/usr/bin/env python3
+import atexit
+import errno
+import functools
 import hashlib
 import os
+import re
+import struct
+import sys
+import time
+from stat import S_ISREG
+
+mygit = ".mygit"
+config_file = os.path.join(mygit, "config")
+head_file = os.path.join(mygit, "HEAD")
+merge_head_file = os.path.join(mygit, "MERGE_HEAD")
+merge_conflicts_file = os.path.join(mygit, "MERGE_CONFLICTS")
+branch_dir = os.path.join(mygit, "refs", "heads")
+packed_refs_file = os.path.join(mygit, "packed-refs")
+objects_dir = os.path.join(mygit, "objects")
+blobs_dir = os.path.join(objects_dir, "blobs")
+trees_dir = os.path.join(objects_dir, "trees")
+manifests_dir = os.path.join(objects_dir, "manifests")
+pack_dir = os.path.join(objects_dir, "pack")
+commit_graph_file = os.path.join(objects_dir, "info", "commit-graph")
+
+# Size of each read when hashing. Large reads mean fewer syscalls, and
+# hashlib releases the GIL while hashing buffers this size
+HASH_CHUNK_SIZE = 1 << 20
+
+
+# Read a setting, first from the environment as MYGIT_<NAME>
+# and then from .mygit/config, which has one "name = value" per line
+def get_config(name, default=None):
+    env_name = "MYGIT_" + name.upper().replace("-", "_").replace(".", "_")
+    if env_name in os.environ:
+        return os.environ[env_name]
+    if os.path.exists(config_file):
+        with open(config_file, "r") as file:
+            for line in file:
+                key, sep, value = line.partition("=")
+                if sep and key.strip() == name:
+                    return value.strip()
+    return default
+
+
+# A setting that can't be used stops the command with an error
+def config_error(name, value):
+    print(f"{command_name()}: error: invalid {name} setting '{value}'", file=sys.stderr)
+    sys.exit(1)
+
+
+# Number of threads used to hash files, defaults to the number of cores
+def hash_workers():
+    workers = get_config("workers")
+    if workers is None:
+        return os.cpu_count() or 1
+    try:
+        return max(1, int(workers))
+    except ValueError:
+        config_error("workers", workers)
+
+
+# Tracing
+# With MYGIT_TRACE set to a file, every command appends one JSON line to it
+# with its wall time, the time spent in each phase, and counters for the
+# I/O it did. Phases are the helper functions marked with @traced. A phase
+# running inside another is counted in both, but a phase running inside
+# itself (e.g. reading the base of a delta) is only counted once
+TRACE_COUNTERS = ("bytes_hashed", "bytes_read", "bytes_written", "files_stated", "commits_parsed")
+
+_trace = None
+
+
+# The name of the running command, e.g. mygit-add
+def command_name():
+    command = os.path.basename(sys.argv[0])
+    return command[:-3] if command.endswith(".py") else command
+
+
+def _new_trace():
+    path = get_config("trace")
+    if not path:
+        return None
+    import threading
+    return {
+        "path": os.path.abspath(path),
+        "command": command_name(),
+        "args": sys.argv[1:],
+        "start": time.time(),
+        "clock": time.perf_counter(),
+        "phases": {},
+        "active": set(),
+        "counters": dict.fromkeys(TRACE_COUNTERS, 0),
+        # Files are hashed on several threads at once
+        "lock": threading.Lock(),
+    }
+
+
+def trace_count(counter, amount=1):
+    if _trace is None:
+        return
+    with _trace["lock"]:
+        _trace["counters"][counter] += amount
+
+
+def traced(phase):
+    def decorate(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            if _trace is None or phase in _trace["active"]:
+                return function(*args, **kwargs)
+            _trace["active"].add(phase)
+            start = time.perf_counter()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                phases = _trace["phases"]
+                phases[phase] = phases.get(phase, 0) + time.perf_counter() - start
+                _trace["active"].discard(phase)
+        return wrapper
+    return decorate
+
+
+# Write the trace of the command that just finished, if it's being traced
+def end_command(status=None):
+    global _trace
+    trace, _trace = _trace, None
+    if trace is None:
+        return
+    import json
+    record = {
+        "command": trace["command"],
+        "args": trace["args"],
+        "pid": os.getpid(),
+        "start": trace["start"],
+        "wall": time.perf_counter() - trace["clock"],
+        "phases": trace["phases"],
+        "counters": trace["counters"],
+    }
+    if status is not None:
+        record["status"] = status
+    with open(trace["path"], "a") as file:
+        file.write(json.dumps(record) + "\n")
+
+
+# A command run on its own is traced from when it imports this
+_trace = _new_trace()
+atexit.register(end_command)
+
+
+# Durability
+# With durability = none, the default, files are written and left for the
+# OS to flush whenever it likes. With batched or full, each command is one
+# transaction. Objects (blobs, chunks, manifests, trees, commits, the
+# commit graph and SEQ) are written as usual and remembered. Writes to
+# refs (HEAD, MERGE_HEAD, branches, the index and the fsmonitor token) are held back
+# until the command ends. Then:
+#   1. the objects are flushed to disk
+#   2. the held back writes go into .mygit/journal-<pid>, which is flushed
+#   3. they are applied, by writing a temporary file and renaming it,
+#      and flushed
+#   4. the journal is removed
+# A crash before the journal is complete leaves every ref as it was. A
+# crash after it means the next command replays the journal, once the
+# process that wrote it has gone. Either way a ref never points at an
+# object that didn't make it to disk.
+#
+# full fsyncs each object as soon as it is written, and each ref as it is
+# applied. batched only remembers them, and fsyncs every file written and
+# every directory they're in once per step, so a file written twice or a
+# directory holding many new files is flushed once. syncfs flushes each
+# step with a single syncfs of the filesystem holding .mygit, which also
+# waits for whatever else is being written to it, so it is only used if
+# asked for.
+journal_file = os.path.join(mygit, f"journal-{os.getpid()}")
+DURABILITY_MODES = ("none", "batched", "full", "syncfs")
+
+_transaction = None
+
+
+def _new_transaction():
+    mode = get_config("durability", "none")
+    if mode not in DURABILITY_MODES:
+        config_error("durability", mode)
+    if mode == "none":
+        return None
+    return {"mode": mode, "objects": {}, "refs": {}}
+
+
+# Remember an object (or a directory) we wrote, so it gets flushed before
+# any ref points to it
+def wrote_object(path):
+    if _transaction is None:
+        return
+    if _transaction["mode"] == "full":
+        _fsync_all([path])
+    else:
+        _transaction["objects"][path] = None
+
+
+# Write a ref (or delete it, if data is None), straight away if durability
+# is none, otherwise at the end of the command
+def write_ref(path, data):
+    forget_parsed(path)
+    if _transaction is None:
+        _apply_refs({path: data}, None)
+    else:
+        _transaction["refs"][path] = data
+
+
+@functools.lru_cache(maxsize=None)
+def _libc():
+    import ctypes
+    import ctypes.util
+    return ctypes.CDLL(ctypes.util.find_library("c") or "libc.so.6", use_errno=True)
+
+
+# Flush everything written to the filesystem holding .mygit with one call
+def _syncfs():
+    fd = os.open(mygit, os.O_RDONLY)
+    try:
+        syncfs = getattr(_libc(), "syncfs", None)
+        if syncfs is None or syncfs(fd) != 0:
+            os.sync()
+    finally:
+        os.close(fd)
+
+
+def _fsync_path(path):
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+# Flush files and then the directories holding them, so new names are on
+# disk too. Each directory is only flushed once
+@traced("durability")
+def _fsync_all(paths, directories=()):
+    directories = set(directories)
+    for path in paths:
+        _fsync_path(path)
+        directories.add(os.path.dirname(path) or ".")
+    for directory in directories:
+        _fsync_path(directory)
+
+
+def _apply_refs(refs, mode):
+    written = []
+    directories = set()
+    for path, data in refs.items():
+        directories.add(os.path.dirname(path) or ".")
+        if data is None:
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            continue
+        # A locked file is written to its lock, and renaming the lock over
+        # it releases the lock
+        if path in _locks:
+            _locks.discard(path)
+            tmp = path + ".lock"
+        else:
+            tmp = path + ".tmp"
+        with open(tmp, "wb") as file:
+            file.write(data)
+            if mode == "full":
+                os.fsync(file.fileno())
+        os.replace(tmp, path)
+        written.append(path)
+    if mode == "batched":
+        _fsync_all(written, directories)
+    elif mode == "full":
+        _fsync_all([], directories)
+    elif mode == "syncfs":
+        _syncfs()
+
+
+def _write_journal(refs, mode):
+    import json
+    body = json.dumps([[path, None if data is None else data.hex()] for path, data in refs.items()])
+    checksum = hashlib.sha1(body.encode()).hexdigest()
+    with open(journal_file, "w") as file:
+        file.write(f"{checksum}\n{body}")
+        file.flush()
+        os.fsync(file.fileno())
+    _fsync_path(mygit)
+
+
+# Finish a command started by an earlier process that crashed part way
+# A journal that wasn't completely written is thrown away, since nothing
+# was applied from it yet
+# The process held the locks of anything it was writing, so those are
+# stale now and are removed
+def _replay_journal(path):
+    import json
+    with open(path, "r") as file:
+        checksum, _, body = file.read().partition("\n")
+    if hashlib.sha1(body.encode()).hexdigest() == checksum:
+        refs = {ref: None if data is None else bytes.fromhex(data) for ref, data in json.loads(body)}
+        _apply_refs(refs, "full")
+        for ref in refs:
+            if os.path.exists(ref + ".lock"):
+                os.remove(ref + ".lock")
+    os.remove(path)
+
+
+def _replay_journals():
+    if not os.path.isdir(mygit):
+        return
+    for name in os.listdir(mygit):
+        prefix, _, pid = name.partition("-")
+        if prefix != "journal" or not pid.isdigit():
+            continue
+        try:
+            os.kill(int(pid), 0)
+            continue
+        except ProcessLookupError:
+            pass
+        except PermissionError:
+            continue
+        _replay_journal(os.path.join(mygit, name))
+
+
+# Flush the objects written so far, e.g. before deleting the copies of
+# them that something else still points to
+def flush_objects():
+    if _transaction is None or not _transaction["objects"]:
+        return
+    if _transaction["mode"] == "syncfs":
+        _syncfs()
+    else:
+        _fsync_all([path for path in _transaction["objects"] if os.path.exists(path)])
+    _transaction["objects"] = {}
+
+
+# Locks still held here were never written to, e.g. the command failed
+@traced("durability")
+def end_transaction():
+    global _transaction
+    if _transaction is not None:
+        flush_objects()
+        transaction, _transaction = _transaction, None
+        refs = transaction["refs"]
+        if refs:
+            _write_journal(refs, transaction["mode"])
+            _apply_refs(refs, transaction["mode"])
+            os.remove(journal_file)
+    for path in list(_locks):
+        unlock_file(path)
+
+
+_replay_journals()
+_transaction = _new_transaction()
+atexit.register(end_transaction)
+
+
+# Branches
+# HEAD holds "ref: refs/heads/<branch>" for the current branch, and each
+# branch is a file in .mygit/refs/heads holding its latest commit id,
+# which is empty until the branch's first commit.
+#
+# mygit-pack-refs moves branches into .mygit/packed-refs, one
+# "<branch> <commit id>" line each, sorted by name so one branch can be
+# found with a binary search. A branch in refs/heads overrides the packed
+# one, so updating a branch just writes its file like before. Deleting a
+# packed branch rewrites packed-refs without it
+PACKED_REFS_HEADER = b"# packed-refs\n"
+def _read_text(path):
+    with open(path, "r") as file:
+        return file.read().strip()
+
+
+# Name of the branch HEAD points to
+def current_branch():
+    head_content = read_parsed(head_file, _read_text)
+    return head_content.replace("ref: ", "").replace("refs/heads/", "", 1)
+
+
+def set_current_branch(branch):
+    write_ref(head_file, f"ref: refs/heads/{branch}\n".encode())
+
+
+def branch_exists(branch):
+    return os.path.isfile(os.path.join(branch_dir, branch)) or packed_branch(branch) is not None
+
+
+# The commit id a branch points to, or "" if it has no commits or doesn't exist
+def read_branch(branch):
+    path = os.path.join(branch_dir, branch)
+    if not os.path.isfile(path):
+        return packed_branch(branch) or ""
+    return read_parsed(path, _read_text)
+
+
+def write_branch(branch, commit_id):
+    write_ref(os.path.join(branch_dir, branch), str(commit_id).encode())
+
+
+def delete_branch(branch):
+    path = os.path.join(branch_dir, branch)
+    if os.path.isfile(path):
+        write_ref(path, None)
+    if packed_branch(branch) is not None:
+        lock_file(packed_refs_file)
+        forget_parsed(packed_refs_file)
+        branches = read_packed_refs()
+        del branches[branch]
+        write_packed_refs(branches)
+
+
+# Look a branch up in packed-refs, returning None if it isn't there
+def packed_branch(branch):
+    if not os.path.exists(packed_refs_file) or os.path.getsize(packed_refs_file) <= len(PACKED_REFS_HEADER):
+        return None
+    import mmap
+    key = branch.encode()
+    with open(packed_refs_file, "rb") as file, mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as data:
+        low, high = len(PACKED_REFS_HEADER), len(data)
+        while low < high:
+            # The line that the middle byte is in
+            start = max(low, data.rfind(b"\n", low, (low + high) // 2) + 1)
+            end = data.find(b"\n", start)
+            if end == -1:
+                end = len(data)
+            name, _, commit_id = data[start:end].partition(b" ")
+            if name < key:
+                low = end + 1
+            elif name > key:
+                high = start
+            else:
+                return commit_id.decode()
+    return None
+
+
+def _parse_packed_refs(path):
+    branches = {}
+    with open(path, "r") as file:
+        for line in file:
+            if not line.startswith("#"):
+                name, _, commit_id = line.rstrip("\n").partition(" ")
+                branches[name] = commit_id
+    return branches
+
+
+# Every packed branch as {branch: commit id}
+def read_packed_refs():
+    if not os.path.exists(packed_refs_file):
+        return {}
+    return dict(read_parsed(packed_refs_file, _parse_packed_refs))
+
+
+def write_packed_refs(branches):
+    lines = [PACKED_REFS_HEADER]
+    for name in sorted(branches, key=str.encode):
+        lines.append(f"{name} {branches[name]}\n".encode())
+    write_ref(packed_refs_file, b"".join(lines))
+
+
+# The commit being merged, while a merge with conflicts waits for them to
+# be fixed and committed, or "" if there isn't one
+def read_merge_head():
+    if not os.path.isfile(merge_head_file):
+        return ""
+    return read_parsed(merge_head_file, _read_text)
+
+
+# The files that had conflicts in that merge, one path a line, which have to
+# be fixed and added before the merge can be committed
+def read_merge_conflicts():
+    if not os.path.isfile(merge_conflicts_file):
+        return []
+    with open(merge_conflicts_file, "rb") as file:
+        return file.read().decode().splitlines()
+
+
+# Passing None removes the merge head and its conflict list together
+def write_merge_head(commit_id, conflicts=()):
+    if commit_id is None:
+        write_ref(merge_conflicts_file, None)
+        write_ref(merge_head_file, None)
+        return
+    write_ref(merge_conflicts_file, "".join(f"{file}\n" for file in conflicts).encode())
+    write_ref(merge_head_file, f"{commit_id}\n".encode())
+
+
+conflict_marker_check = re.compile(rb'^(<<<<<<<|>>>>>>>)( |$)', re.MULTILINE)
+
+
+def has_conflict_markers(data):
+    return conflict_marker_check.search(data) is not None
+
+
+def list_branches():
+    if not os.path.exists(packed_refs_file):
+        return sorted(os.listdir(branch_dir))
+    return sorted(set(os.listdir(branch_dir)) | read_packed_refs().keys())
+
 
 # Get the sha1sum of a file
 def file_sha1sum(filepath):
     h = hashlib.sha1()
-    with open(filepath, 'rb') as file:
-        while part := file.read(4096):
-            h.update(part)
+    buffer = bytearray(HASH_CHUNK_SIZE)
+    view = memoryview(buffer)
+    with open(filepath, 'rb', buffering=0) as file:
+        total = 0
+        while size := file.readinto(buffer):
+            h.update(view[:size])
+            total += size
+    trace_count("bytes_hashed", total)
+    trace_count("bytes_read", total)
     return h.hexdigest()
 
 
+def _sha1_or_none(filepath):
+    try:
+        return file_sha1sum(filepath)
+    except FileNotFoundError:
+        return None
+
+
+# Get the sha1sum of many files at once, using a pool of threads
+# Results are in the same order as filepaths, with None for missing files
+@traced("hash")
+def hash_files(filepaths, workers=None):
+    filepaths = list(filepaths)
+    workers = min(workers or hash_workers(), len(filepaths))
+    if workers <= 1:
+        return [_sha1_or_none(path) for path in filepaths]
+
+    from concurrent.futures import ThreadPoolExecutor
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        return list(pool.map(_sha1_or_none, filepaths))
+
+
 # Read the current commit number we are on
 def read_seq(seq_file):
     with open(seq_file, "r") as file:
@@ -27,11 +552,2026 @@ def bump_seq(seq_file, new_last):
     with open(tmp, "w") as file:
         file.write(f"{new_last}")
     os.replace(tmp, seq_file)
+    wrote_object(seq_file)
 
 
-def write_index(path, mapping: dict):
-    tmp = path + ".tmp"
-    with open(tmp, "w") as file:
-        for name, sha1 in sorted(mapping.items()):
-            file.write(f"{name} {sha1}\n")
-    os.replace(tmp, path)
\ No newline at end of file
+# Stat data cached next to each sha1 in the index
+# (mtime_ns, size, inode, ctime_ns). If none of these changed since the
+# file was hashed, we trust the sha1 in the index instead of re-hashing
+def file_stat(filepath):
+    trace_count("files_stated")
+    return stat_data(os.stat(filepath))
+
+def stat_data(st):
+    return (st.st_mtime_ns, st.st_size, st.st_ino, st.st_ctime_ns)
+
+
+# A file modified in the same second as the index was written could be
+# modified again without its mtime changing, so its stat data can't be trusted
+def is_racy(stat, index_mtime_ns):
+    return stat[0] // 1_000_000_000 >= index_mtime_ns // 1_000_000_000
+
+
+# Parsed files are kept for as long as the process runs, so a batch of
+# commands run by mygit batch only parses the index, HEAD, refs, packs and
+# the commit graph again when they change. Within one command a file is
+# only checked once, and our own writes forget the cached copy. Between
+# commands a cached copy is used only while the file's stat data is
+# unchanged, and never if the file was modified in the same second it was
+# read, for the same reason racy index entries aren't trusted
+_parsed = {}
+_checked = set()
+
+
+def read_parsed(path, parse):
+    cached = _parsed.get(path)
+    if cached is not None and path in _checked:
+        return cached[1]
+    try:
+        stat = file_stat(path)
+    except FileNotFoundError:
+        _parsed.pop(path, None)
+        return parse(path)
+    if cached is not None and cached[0] == stat and not cached[2]:
+        _checked.add(path)
+        return cached[1]
+    value = parse(path)
+    _parsed[path] = (stat, value, is_racy(stat, time.time_ns()))
+    _checked.add(path)
+    return value
+
+
+def forget_parsed(path):
+    _parsed.pop(path, None)
+    _checked.discard(path)
+
+
+# Start of a new command in the same process, so cached files need checking
+def start_command():
+    global _trace, _transaction
+    _checked.clear()
+    _opened.clear()
+    _trace = _new_trace()
+    _transaction = _new_transaction()
+
+
+# The index
+# The index is a binary file, sorted by filename so a single entry can be
+# found by binary search without reading the rest of it:
+#   header  "MGIX" version count
+#   records one fixed-width record per file (INDEX_RECORD), in filename
+#           order, holding the raw sha1, the stat data, a flag saying if
+#           the stat data is set, and where the filename is in the names
+#   names   every filename, one after another
+#   trailer sha1 of everything before it, to catch corruption
+# Older repositories have a text index, one "filename sha1 [stat data]"
+# per line. It is still read, and mygit-convert-index converts it.
+INDEX_HEADER = struct.Struct(">4sII")
+INDEX_RECORD = struct.Struct(">20sqQQqHHI")
+INDEX_VERSION = 2
+INDEX_HAS_STAT = 1
+
+
+class IndexCorrupt(Exception):
+    pass
+
+
+def is_binary_index(data):
+    return data[:4] == b"MGIX"
+
+
+# Load the index file
+# Returns {filename: sha1} and {filename: stat data}
+def read_index(path):
+    try:
+        index_map, stats = read_parsed(path, _parse_index)
+    except IndexCorrupt as error:
+        _index_corrupt(error)
+    return dict(index_map), dict(stats)
+
+
+# No command can do anything useful with a corrupt index, so stop with an
+# error instead of a traceback
+def _index_corrupt(error):
+    print(f"{command_name()}: error: index file is corrupt ({error})", file=sys.stderr)
+    sys.exit(1)
+
+
+@traced("read_index")
+def _parse_index(path):
+    if not os.path.exists(path):
+        return {}, {}
+    with open(path, "rb") as file:
+        data = file.read()
+    trace_count("bytes_read", len(data))
+    if is_binary_index(data):
+        return _parse_binary_index(data)
+    return _parse_text_index(data.decode())
+
+
+def _parse_text_index(text):
+    index_map = {}
+    stats = {}
+    for line in text.splitlines():
+        fields = line.split()
+        if not fields:
+            continue
+        index_map[fields[0]] = fields[1]
+        if len(fields) == 6:
+            stats[fields[0]] = tuple(int(field) for field in fields[2:])
+    return index_map, stats
+
+
+def _check_index(data):
+    if len(data) < INDEX_HEADER.size + 20:
+        raise IndexCorrupt("index file is truncated")
+    magic, version, count = INDEX_HEADER.unpack_from(data)
+    if version != INDEX_VERSION:
+        raise IndexCorrupt(f"unknown index version {version}")
+    if INDEX_HEADER.size + count * INDEX_RECORD.size + 20 > len(data):
+        raise IndexCorrupt("index file is truncated")
+    return count
+
+
+def _parse_binary_index(data):
+    count = _check_index(data)
+    if hashlib.sha1(data[:-20]).digest() != data[-20:]:
+        raise IndexCorrupt("index checksum does not match")
+    names_start = INDEX_HEADER.size + count * INDEX_RECORD.size
+    index_map = {}
+    stats = {}
+    records = memoryview(data)[INDEX_HEADER.size:names_start]
+    for raw_sha1, mtime, size, inode, ctime, flags, name_length, name_offset in INDEX_RECORD.iter_unpack(records):
+        start = names_start + name_offset
+        name = data[start:start + name_length].decode()
+        index_map[name] = raw_sha1.hex()
+        if flags & INDEX_HAS_STAT:
+            stats[name] = (mtime, size, inode, ctime)
+    return index_map, stats
+
+
+# Find one file in the index without loading all of it
+# The index is memory-mapped and binary searched by filename. Only the
+# header and the records we look at are checked, not the whole checksum.
+# Returns the sha1, or None if the file isn't in the index
+def index_lookup(path, filename):
+    if not os.path.exists(path) or os.path.getsize(path) == 0:
+        return None
+    import mmap
+    with open(path, "rb") as file, mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as data:
+        if not is_binary_index(data):
+            return _parse_text_index(data[:].decode())[0].get(filename)
+        try:
+            count = _check_index(data)
+        except IndexCorrupt as error:
+            _index_corrupt(error)
+        names_start = INDEX_HEADER.size + count * INDEX_RECORD.size
+        key = filename.encode()
+        low, high = 0, count
+        while low < high:
+            middle = (low + high) // 2
+            record = INDEX_RECORD.unpack_from(data, INDEX_HEADER.size + middle * INDEX_RECORD.size)
+            start = names_start + record[7]
+            name = data[start:start + record[6]]
+            if name < key:
+                low = middle + 1
+            elif name > key:
+                high = middle
+            else:
+                return record[0].hex()
+    return None
+
+
+# Write the index file, with the stat data of each entry if we have it
+# Racy entries are written without stat data so they get re-hashed next time
+@traced("write_index")
+def write_index(path, mapping: dict, stats=None):
+    stats = stats or {}
+    now_ns = time.time_ns()
+    entries = sorted((name.encode(), name, sha1) for name, sha1 in mapping.items())
+
+    records = bytearray()
+    names = bytearray()
+    for encoded, name, sha1 in entries:
+        stat = stats.get(name)
+        if stat is None or is_racy(stat, now_ns):
+            stat = (0, 0, 0, 0)
+            flags = 0
+        else:
+            flags = INDEX_HAS_STAT
+        records += INDEX_RECORD.pack(bytes.fromhex(sha1), *stat, flags, len(encoded), len(names))
+        names += encoded
+
+    data = INDEX_HEADER.pack(b"MGIX", INDEX_VERSION, len(entries)) + records + names
+    data += hashlib.sha1(data).digest()
+    trace_count("bytes_written", len(data))
+    if path not in _locks:
+        lock_file(path)
+    write_ref(path, bytes(data))
+
+
+# Index locking
+# Only one process can hold <index>.lock, which is created with O_EXCL.
+# The new index is written into the lock, which is then renamed over the
+# index, so readers only ever see a whole index and writers can't lose
+# each other's changes. A command that can't get the lock keeps trying
+# for index-lock-timeout seconds (default: 10). packed-refs is locked the
+# same way.
+#
+# open_index takes the lock before reading, so a command holds it for
+# everything it does and commands that change the index take turns. With
+# index-merge set, it doesn't: the lock is only taken by save_index, and if
+# another command saved the index in the meantime, the index is read again
+# and the changes this command made are applied to it instead. Changes to
+# the same file by both commands end up as this command made them
+_locks = set()
+_opened = {}
+
+
+class FileLocked(Exception):
+    pass
+
+
+def lock_file(path):
+    lock = path + ".lock"
+    deadline = time.monotonic() + float(get_config("index-lock-timeout", 10))
+    while True:
+        try:
+            os.close(os.open(lock, os.O_CREAT | os.O_EXCL | os.O_WRONLY, 0o666))
+            _locks.add(path)
+            return
+        except FileExistsError:
+            if time.monotonic() >= deadline:
+                raise FileLocked(
+                    f"unable to create '{lock}': another mygit command seems to be running, "
+                    "if not, remove the file"
+                )
+            time.sleep(0.01)
+
+
+def unlock_file(path):
+    if path in _locks:
+        _locks.discard(path)
+        os.remove(path + ".lock")
+
+
+def _index_identity(path):
+    try:
+        st = os.stat(path)
+    except FileNotFoundError:
+        return None
+    return st.st_ino, st.st_mtime_ns, st.st_size
+
+
+# Read the index of a command that is going to change it with save_index
+def open_index(path):
+    if not get_config("index-merge"):
+        lock_file(path)
+        return read_index(path)
+    identity = _index_identity(path)
+    index_map, stats = read_index(path)
+    _opened[path] = (identity, dict(index_map), dict(stats))
+    return index_map, stats
+
+
+def save_index(path, index_map, stats):
+    if path in _locks or path not in _opened:
+        write_index(path, index_map, stats)
+        return
+    identity, original_map, original_stats = _opened.pop(path)
+    lock_file(path)
+    if _index_identity(path) != identity:
+        forget_parsed(path)
+        current_map, current_stats = read_index(path)
+        for name in original_map.keys() - index_map.keys():
+            current_map.pop(name, None)
+            current_stats.pop(name, None)
+        for name, sha1 in index_map.items():
+            if original_map.get(name) != sha1 or original_stats.get(name) != stats.get(name):
+                current_map[name] = sha1
+                if name in stats:
+                    current_stats[name] = stats[name]
+                else:
+                    current_stats.pop(name, None)
+        index_map, stats = current_map, current_stats
+    write_index(path, index_map, stats)
+
+
+# Get the sha1 of each given working file, using the stat data in the index
+# to skip hashing files that haven't changed since they were last hashed.
+# Files that are missing from the working directory are left out.
+# Re-hashed files that match the index get their stat data refreshed in stats
+# If new_stats is given, re-hashed files that don't match get the stat data
+# they were hashed with put there, for a caller that is staging them
+# If changed is the set of files the fsmonitor says may have changed, files
+# not in it that have stat data in the index aren't even stat'd
+@traced("check_working_files")
+def working_sha1s(filenames, index_map, stats, index_path, changed=None, new_stats=None):
+    try:
+        index_mtime = os.stat(index_path).st_mtime_ns
+    except FileNotFoundError:
+        index_mtime = 0
+
+    result = {}
+    to_hash = []
+    stated = 0
+    for name in filenames:
+        if changed is not None and name not in changed and name in stats and name in index_map:
+            result[name] = index_map[name]
+            continue
+        stated += 1
+        try:
+            st = os.stat(name)
+        except FileNotFoundError:
+            continue
+        if not S_ISREG(st.st_mode):
+            continue
+        stat = stat_data(st)
+        index_sha1 = index_map.get(name)
+        if index_sha1 is not None and stats.get(name) == stat and not is_racy(stat, index_mtime):
+            result[name] = index_sha1
+        else:
+            to_hash.append((name, stat))
+    trace_count("files_stated", stated)
+
+    # Hash everything else in one batch
+    hashes = hash_files(name for name, _ in to_hash)
+    for (name, stat), sha1 in zip(to_hash, hashes):
+        if sha1 is None:
+            continue
+        result[name] = sha1
+        if sha1 == index_map.get(name):
+            stats[name] = stat
+        else:
+            stats.pop(name, None)
+            if new_stats is not None:
+                new_stats[name] = stat
+    return result
+
+
+# Working tree
+# Paths in the working directory are names joined by "/", and every name
+# has to be a valid mygit name, so anything starting with a dot (like .mygit)
+# is skipped. .mygitignore has one pattern per line, with # for comments:
+#   build/          a directory called build, anywhere, and all under it
+#   *.o             any file or directory matching, anywhere
+#   docs/*.html     a pattern with a / in it matches the whole path
+# Ignored directories are never descended into. Tracked files are still
+# tracked if a pattern matches them, like in git
+ignore_file = ".mygitignore"
+VALID_NAME = re.compile(r'[a-zA-Z0-9][a-zA-Z0-9._-]*')
+
+
+def valid_path(path):
+    return all(VALID_NAME.fullmatch(name) for name in path.split("/"))
+
+
+# Returns [(pattern, only matches directories, matches the whole path)]
+def _parse_ignore(path):
+    patterns = []
+    with open(path, "r") as file:
+        for line in file:
+            pattern = line.strip()
+            if not pattern or pattern.startswith("#"):
+                continue
+            dir_only = pattern.endswith("/")
+            pattern = pattern.strip("/")
+            if pattern:
+                patterns.append((pattern, dir_only, "/" in pattern))
+    return patterns
+
+
+def ignore_patterns():
+    if not os.path.exists(ignore_file):
+        return []
+    return read_parsed(ignore_file, _parse_ignore)
+
+
+def is_ignored(path, is_dir, patterns):
+    from fnmatch import fnmatchcase
+    name = path.rpartition("/")[2]
+    for pattern, dir_only, whole_path in patterns:
+        if dir_only and not is_dir:
+            continue
+        if fnmatchcase(path if whole_path else name, pattern):
+            return True
+    return False
+
+
+# Whether a path, or any directory it's in, is ignored
+def path_ignored(path, patterns):
+    parts = path.split("/")
+    for depth in range(1, len(parts)):
+        if is_ignored("/".join(parts[:depth]), True, patterns):
+            return True
+    return is_ignored(path, False, patterns)
+
+
+# Every file under a directory (the whole working directory by default)
+# as a set of paths. The file types os.scandir gets while reading each
+# directory are used, so files aren't stat'd. If given, dirs gets every
+# directory that was descended into
+@traced("scan")
+def scan_working_files(directory="", dirs=None):
+    patterns = ignore_patterns()
+    files = set()
+    pending = [directory]
+    while pending:
+        current = pending.pop()
+        try:
+            entries = os.scandir(current or ".")
+        except (FileNotFoundError, NotADirectoryError):
+            continue
+        with entries:
+            for entry in entries:
+                if not VALID_NAME.fullmatch(entry.name):
+                    continue
+                path = f"{current}/{entry.name}" if current else entry.name
+                if entry.is_dir(follow_symlinks=False):
+                    if not is_ignored(path, True, patterns):
+                        pending.append(path)
+                        if dirs is not None:
+                            dirs.append(path)
+                elif entry.is_file(follow_symlinks=False) and not is_ignored(path, False, patterns):
+                    files.add(path)
+    return files
+
+
+# The files in the working directory as (files, changed, token), from the
+# fsmonitor if it's running, like query_fsmonitor, and otherwise from a scan,
+# with changed and token None. Tracked files that are ignored aren't seen
+# by either, so they're added here, and are always checked
+def working_tree(index_map):
+    monitor = query_fsmonitor()
+    if monitor is None:
+        files, changed, token = scan_working_files(), None, None
+    else:
+        files, changed, token = monitor
+    patterns = ignore_patterns()
+    if patterns:
+        for path in index_map:
+            if path not in files and path_ignored(path, patterns) and os.path.isfile(path):
+                files.add(path)
+                if changed is not None:
+                    changed.add(path)
+    return files, changed, token
+
+
+# Remove a working file, and the directories it was in if that empties them
+def remove_working_file(path):
+    os.remove(path)
+    directory = os.path.dirname(path)
+    if directory:
+        try:
+            os.removedirs(directory)
+        except OSError:
+            pass
+
+
+# Filesystem monitor
+# mygit-fsmonitor runs a daemon that watches the working directory with
+# inotify. Commands ask it over a Unix socket for the files in the working
+# directory, and which of them changed since the token saved by the last
+# command that asked, so files that didn't change aren't stat'd or hashed.
+# A command only saves the token once the index on disk has checked stat
+# data for every file it looked at, so a file that isn't reported as
+# changed still matches its index entry. If the daemon isn't running,
+# commands scan the working directory like before
+fsmonitor_socket = os.path.join(mygit, "fsmonitor.sock")
+fsmonitor_token_file = os.path.join(mygit, "fsmonitor-token")
+
+# Seconds to wait for the daemon before scanning instead
+FSMONITOR_TIMEOUT = 2
+
+
+# Ask the daemon what's in the working directory
+# Returns (files, changed, token), where changed is None if every file has
+# to be checked, or None if the daemon isn't running
+@traced("fsmonitor")
+def query_fsmonitor():
+    if not os.path.exists(fsmonitor_socket):
+        return None
+    import json
+    import socket
+    token = _read_text(fsmonitor_token_file) if os.path.exists(fsmonitor_token_file) else ""
+    try:
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as client:
+            client.settimeout(FSMONITOR_TIMEOUT)
+            client.connect(fsmonitor_socket)
+            client.sendall(f"query {token}\n".encode())
+            chunks = []
+            while chunk := client.recv(1 << 16):
+                chunks.append(chunk)
+        reply = json.loads(b"".join(chunks))
+    except (OSError, ValueError):
+        return None
+    changed = None if reply["full"] else set(reply["changed"])
+    return set(reply["files"]), changed, reply["token"]
+
+
+# The token goes with the index, so it's written after it
+def save_fsmonitor_token(token):
+    write_ref(fsmonitor_token_file, token.encode())
+
+
+# Object paths
+# Objects are sharded into subdirectories named by two hex characters,
+# like git, so no single directory gets too big:
+#   blobs   .mygit/objects/blobs/ab/cdef0123...
+#   commits .mygit/objects/<commit_id % 256 in hex>/<commit_id>.json
+# Repositories made before sharding keep everything flat until they run
+# mygit-shard-objects, so reads fall back to the flat paths
+def shard_path(directory, name, shard):
+    return os.path.join(directory, shard, name)
+
+
+# Where a blob is written
+def blob_path(sha1):
+    return shard_path(blobs_dir, sha1, sha1[:2])
+
+
+# Where a blob is stored loose, or None if it isn't
+def loose_blob(sha1):
+    path = blob_path(sha1)
+    if os.path.exists(path):
+        return path
+    flat_path = os.path.join(blobs_dir, sha1)
+    if os.path.exists(flat_path):
+        return flat_path
+    return None
+
+
+# Every loose blob as (sha1, path), sharded or flat
+def loose_blobs():
+    if not os.path.isdir(blobs_dir):
+        return
+    for name in os.listdir(blobs_dir):
+        path = os.path.join(blobs_dir, name)
+        if len(name) == 2 and os.path.isdir(path):
+            for rest in os.listdir(path):
+                if len(rest) == 40:
+                    yield rest, os.path.join(path, rest)
+        elif len(name) == 40 and os.path.isfile(path):
+            yield name, path
+
+
+# Every commit as (commit_id, path), sharded or flat
+def loose_commits():
+    for name in os.listdir(objects_dir):
+        path = os.path.join(objects_dir, name)
+        if len(name) == 2 and os.path.isdir(path):
+            for rest in os.listdir(path):
+                if rest.endswith(".json") and rest[:-5].isdigit():
+                    yield rest[:-5], os.path.join(path, rest)
+        elif name.endswith(".json") and name[:-5].isdigit():
+            yield name[:-5], path
+
+
+def commit_shard(commit_id):
+    return f"{int(commit_id) % 256:02x}"
+
+
+# Where a commit is stored, or where it should be written if it doesn't exist
+def commit_path(commit_id):
+    path = shard_path(objects_dir, f"{commit_id}.json", commit_shard(commit_id))
+    if os.path.exists(path):
+        return path
+    flat_path = os.path.join(objects_dir, f"{commit_id}.json")
+    if os.path.exists(flat_path):
+        return flat_path
+    return path
+
+
+def commit_exists(commit_id):
+    return os.path.exists(commit_path(commit_id))
+
+
+# Make the shard directory for an object we are about to write
+def make_shard_dir(path):
+    directory = os.path.dirname(path)
+    if not os.path.isdir(directory):
+        os.makedirs(directory, exist_ok=True)
+        wrote_object(directory)
+
+
+# Trees
+# A commit points to a tree instead of listing every file. A tree lists
+# the files and subdirectories of one directory, one per line:
+#   blob <sha1> <name>
+#   tree <sha1> <name>
+# sorted by name, and is stored under the sha1 of its contents in
+# .mygit/objects/trees. A snapshot that didn't change has the same tree
+# sha1 as before, so it costs nothing to store, and two snapshots with the
+# same tree sha1 are the same without looking at any of their files.
+# The same goes for every unchanged subdirectory.
+def tree_path(sha1):
+    return shard_path(trees_dir, sha1, sha1[:2])
+
+
+# Every stored tree as (sha1, path)
+def loose_trees():
+    if not os.path.isdir(trees_dir):
+        return
+    for shard in os.listdir(trees_dir):
+        shard_dir = os.path.join(trees_dir, shard)
+        if len(shard) == 2 and os.path.isdir(shard_dir):
+            for name in os.listdir(shard_dir):
+                if len(name) == 40:
+                    yield name, os.path.join(shard_dir, name)
+
+
+# Build the trees for a {path: sha1} map
+# Returns the sha1 of the root tree and {sha1: contents} of every tree
+def build_trees(files):
+    root = {}
+    for path, sha1 in files.items():
+        parts = path.split("/")
+        node = root
+        for part in parts[:-1]:
+            node = node.setdefault(part, {})
+        node[parts[-1]] = sha1
+
+    trees = {}
+
+    def build(node):
+        lines = []
+        for name in sorted(node):
+            value = node[name]
+            if isinstance(value, dict):
+                lines.append(f"tree {build(value)} {name}\n")
+            else:
+                lines.append(f"blob {value} {name}\n")
+        contents = "".join(lines).encode()
+        sha1 = hashlib.sha1(contents).hexdigest()
+        trees[sha1] = contents
+        return sha1
+
+    return build(root), trees
+
+
+# The sha1 of the root tree of a {path: sha1} map, without storing anything
+def tree_hash(files):
+    return build_trees(files)[0]
+
+
+# Store the trees for a {path: sha1} map and return the root tree's sha1
+# Trees we already have aren't written again
+def write_tree(files):
+    root, trees = build_trees(files)
+    for sha1, contents in trees.items():
+        path = tree_path(sha1)
+        if os.path.exists(path):
+            continue
+        make_shard_dir(path)
+        tmp = path + ".tmp"
+        with open(tmp, "wb") as file:
+            file.write(contents)
+        os.replace(tmp, path)
+        wrote_object(path)
+    return root
+
+
+# Read the entries of a tree as (kind, sha1, name)
+# Trees never change, so they can be cached
+@functools.lru_cache(maxsize=4096)
+@traced("load_tree")
+def read_tree(sha1):
+    with open(tree_path(sha1), "r") as file:
+        entries = []
+        for line in file:
+            if line.strip():
+                kind, entry_sha1, name = line.rstrip("\n").split(" ", 2)
+                # The same names come up in tree after tree, so they share one string
+                entries.append((sys.intern(kind), entry_sha1, sys.intern(name)))
+        return tuple(entries)
+
+
+# Flatten a tree into a {path: sha1} map
+def tree_files(sha1, prefix=""):
+    files = {}
+    for kind, entry_sha1, name in read_tree(sha1):
+        if kind == "tree":
+            files.update(tree_files(entry_sha1, prefix + name + "/"))
+        else:
+            files[sys.intern(prefix + name) if prefix else name] = entry_sha1
+    return files
+
+
+# Find the sha1 of one file in a tree, only reading the trees on its path
+# Returns None if the file isn't there
+def tree_lookup(sha1, path):
+    parts = path.split("/")
+    for depth, part in enumerate(parts):
+        last = depth == len(parts) - 1
+        for kind, entry_sha1, name in read_tree(sha1):
+            if name == part and (kind == "blob") == last:
+                sha1 = entry_sha1
+                break
+        else:
+            return None
+    return sha1
+
+
+# Find the files that differ between two trees, as (path, sha1 in one,
+# sha1 in two), with None where a file is missing. Subdirectories with
+# the same tree sha1 are skipped without reading them
+def diff_trees(one, two, prefix=""):
+    if one == two:
+        return
+    left = {name: (kind, sha1) for kind, sha1, name in read_tree(one)} if one else {}
+    right = {name: (kind, sha1) for kind, sha1, name in read_tree(two)} if two else {}
+    for name in sorted(left.keys() | right.keys()):
+        old = left.get(name)
+        new = right.get(name)
+        if old == new:
+            continue
+        path = prefix + name
+        if old and new and old[0] == new[0] == "tree":
+            yield from diff_trees(old[1], new[1], path + "/")
+            continue
+        old_files = _entry_files(old, path)
+        new_files = _entry_files(new, path)
+        for file in sorted(old_files.keys() | new_files.keys()):
+            if old_files.get(file) != new_files.get(file):
+                yield file, old_files.get(file), new_files.get(file)
+
+
+def _entry_files(entry, path):
+    if entry is None:
+        return {}
+    if entry[0] == "tree":
+        return tree_files(entry[1], path + "/")
+    return {path: entry[1]}
+
+
+# Packfiles
+# A pack holds many blobs in one file, each compressed with zlib and
+# optionally stored as a delta against another blob in the same pack.
+#
+# pack-<id>.pack:
+#   header  "MPCK" version count
+#   entries type(1 = full, 2 = delta) compressed_length [base sha1] zlib data
+#   trailer sha1 of everything before it
+#
+# pack-<id>.idx:
+#   header  "MIDX" version count
+#   records raw sha1 (20 bytes) and offset into the pack, sorted by sha1
+#   trailer sha1 of the pack
+PACK_HEADER = struct.Struct(">4sII")
+PACK_ENTRY = struct.Struct(">BQ")
+IDX_HEADER = struct.Struct(">4sII")
+IDX_RECORD = struct.Struct(">20sQ")
+PACK_FULL = 1
+PACK_DELTA = 2
+
+# Longest chain of deltas we allow before storing a blob in full
+MAX_DELTA_DEPTH = 10
+
+# Load the index of every pack in the pack directory
+# Each pack is (pack path, idx records, record count)
+def load_packs():
+    return read_parsed(pack_dir, _parse_packs)
+
+
+def _parse_packs(directory):
+    packs = []
+    if not os.path.isdir(directory):
+        return packs
+    for name in sorted(os.listdir(directory)):
+        if not name.endswith(".idx"):
+            continue
+        with open(os.path.join(directory, name), "rb") as file:
+            data = file.read()
+        magic, version, count = IDX_HEADER.unpack_from(data)
+        if magic != b"MIDX" or version != 1:
+            continue
+        records = data[IDX_HEADER.size:IDX_HEADER.size + count * IDX_RECORD.size]
+        packs.append((os.path.join(directory, name[:-4] + ".pack"), records, count))
+    return packs
+
+
+# Forget the loaded packs, after a repack has changed them
+def reset_packs():
+    forget_parsed(pack_dir)
+
+
+# Binary search a pack index for a sha1
+# Returns the offset of the object in the pack, or None
+def _pack_offset(records, count, raw_sha1):
+    low, high = 0, count
+    while low < high:
+        middle = (low + high) // 2
+        start = middle * IDX_RECORD.size
+        key = records[start:start + 20]
+        if key < raw_sha1:
+            low = middle + 1
+        elif key > raw_sha1:
+            high = middle
+        else:
+            return IDX_RECORD.unpack_from(records, start)[1]
+    return None
+
+
+# Find which pack a blob is in
+# Returns (pack path, offset) or None
+def find_packed(sha1):
+    raw_sha1 = bytes.fromhex(sha1)
+    for pack_path, records, count in load_packs():
+        offset = _pack_offset(records, count, raw_sha1)
+        if offset is not None:
+            return pack_path, offset
+    return None
+
+
+# Read an entry of a pack
+# Returns (type, base sha1 or None, uncompressed data)
+def read_pack_entry(pack_path, offset):
+    import zlib
+    with open(pack_path, "rb") as file:
+        file.seek(offset)
+        kind, length = PACK_ENTRY.unpack(file.read(PACK_ENTRY.size))
+        base = file.read(20).hex() if kind == PACK_DELTA else None
+        data = zlib.decompress(file.read(length))
+    trace_count("bytes_read", length)
+    return kind, base, data
+
+
+def blob_exists(sha1):
+    return (
+        loose_blob(sha1) is not None or os.path.exists(manifest_path(sha1))
+        or find_packed(sha1) is not None
+    )
+
+
+# Get the contents of a blob, whether it is loose or in a pack
+@traced("read_blob")
+def read_blob(sha1):
+    path = loose_blob(sha1)
+    if path is not None:
+        with open(path, "rb") as file:
+            data = file.read()
+        trace_count("bytes_read", len(data))
+        return data
+    manifest = read_manifest(sha1)
+    if manifest is not None:
+        return b"".join(read_blob(chunk_sha1) for chunk_sha1, _ in manifest[1])
+    location = find_packed(sha1)
+    if location is None:
+        raise FileNotFoundError(f"blob {sha1} not found")
+    kind, base, data = read_pack_entry(*location)
+    if kind == PACK_DELTA:
+        data = apply_delta(read_blob(base), data)
+    return data
+
+
+# Blobs at least this big are copied to an output by the kernel with
+# sendfile, smaller ones are cheaper to read and write through the buffer
+SENDFILE_MIN_SIZE = 64 * 1024
+
+
+# Write the contents of a blob to a binary file object, without loading
+# a loose blob into memory. If given, prefix is called with the blob's
+# size and what it returns is written before the contents
+# Returns the number of bytes of contents written
+@traced("send_blob")
+def send_blob(sha1, out, prefix=None):
+    path = loose_blob(sha1)
+    if path is None:
+        # Chunked blobs are sent a chunk at a time
+        manifest = read_manifest(sha1)
+        if manifest is not None:
+            size, chunks = manifest
+            if prefix is not None:
+                out.write(prefix(size))
+            for chunk_sha1, _ in chunks:
+                send_blob(chunk_sha1, out)
+            return size
+        data = read_blob(sha1)
+        if prefix is not None:
+            out.write(prefix(len(data)))
+        out.write(data)
+        trace_count("bytes_written", len(data))
+        return len(data)
+    with open(path, "rb") as src:
+        size = os.fstat(src.fileno()).st_size
+        if prefix is not None:
+            out.write(prefix(size))
+        trace_count("bytes_read", size)
+        trace_count("bytes_written", size)
+        if size < SENDFILE_MIN_SIZE:
+            out.write(src.read())
+            return size
+        out.flush()
+        copy_fd(src.fileno(), out.fileno(), size)
+    return size
+
+
+# Copy size bytes from the start of one file descriptor to another (or
+# the rest of them, from offset), with sendfile where the system has it
+# and chunks of bytes where not
+def copy_fd(src_fd, dst_fd, size, offset=0):
+    if hasattr(os, "sendfile"):
+        try:
+            while offset < size:
+                sent = os.sendfile(dst_fd, src_fd, offset, size - offset)
+                if sent == 0:
+                    break
+                offset += sent
+        except OSError as error:
+            # Some outputs can't be written by sendfile, copy those below
+            if error.errno not in (errno.EINVAL, errno.ENOSYS, errno.EOPNOTSUPP):
+                raise
+    while offset < size:
+        chunk = os.pread(src_fd, min(HASH_CHUNK_SIZE, size - offset), offset)
+        if not chunk:
+            break
+        view = memoryview(chunk)
+        while view:
+            view = view[os.write(dst_fd, view):]
+        offset += len(chunk)
+
+
+# Copy a working file into the object store as a blob, unless it's already there
+@traced("store_blob")
+def store_blob(filename, sha1):
+    if blob_exists(sha1):
+        return
+    threshold, chunk_size = chunk_config()
+    if threshold is not None and os.path.getsize(filename) >= threshold:
+        store_chunked(filename, sha1, chunk_size)
+        return
+    import shutil
+    path = blob_path(sha1)
+    make_shard_dir(path)
+    # copyfile rather than copy2, so the blob's mtime is when it was stored
+    # and mygit-gc's grace period covers it, not when the file last changed
+    shutil.copyfile(filename, path)
+    wrote_object(path)
+    if _trace is not None:
+        size = os.path.getsize(path)
+        trace_count("bytes_read", size)
+        trace_count("bytes_written", size)
+
+
+# Linux's FICLONE ioctl, from <linux/fs.h>
+FICLONE = 0x40049409
+_can_reflink = True
+
+
+# Make dst_fd share src_fd's data on disk, on filesystems like btrfs and
+# XFS that can. Returns False if this filesystem can't
+def reflink(src_fd, dst_fd):
+    global _can_reflink
+    if not _can_reflink:
+        return False
+    import fcntl
+    try:
+        fcntl.ioctl(dst_fd, FICLONE, src_fd)
+        return True
+    except OSError as error:
+        # Different filesystems can still clone, so only give up on
+        # reflinks for good if the kernel doesn't know the ioctl
+        if error.errno in (errno.ENOTTY, errno.ENOSYS):
+            _can_reflink = False
+        return False
+
+
+# Copy size bytes from one file to another inside the kernel, with
+# copy_file_range if it works between these two files, otherwise copy_fd
+def copy_file(src_fd, dst_fd, size):
+    offset = 0
+    if hasattr(os, "copy_file_range"):
+        try:
+            while offset < size:
+                copied = os.copy_file_range(src_fd, dst_fd, size - offset, offset)
+                if copied == 0:
+                    break
+                offset += copied
+        except OSError as error:
+            if error.errno not in (errno.EXDEV, errno.EINVAL, errno.ENOSYS, errno.EOPNOTSUPP, errno.EBADF):
+                raise
+    copy_fd(src_fd, dst_fd, size, offset)
+
+
+# Write the contents of a blob to a file in the working directory
+# The blob goes into a temporary file that is renamed over the working file,
+# so a crash never leaves a half written file. Loose blobs are reflinked or
+# copied inside the kernel and chunked blobs are copied a chunk at a time,
+# so memory use doesn't depend on the size of the file. Packed blobs are
+# read into memory, but those are at most pack-max-blob-size
+@traced("write_blob")
+def write_blob_to(sha1, filename):
+    def write(dst):
+        path = loose_blob(sha1)
+        if path is not None:
+            with open(path, "rb") as src:
+                size = os.fstat(src.fileno()).st_size
+                if not reflink(src.fileno(), dst.fileno()):
+                    copy_file(src.fileno(), dst.fileno(), size)
+            trace_count("bytes_read", size)
+            trace_count("bytes_written", size)
+        elif os.path.exists(manifest_path(sha1)):
+            send_blob(sha1, dst)
+        else:
+            data = read_blob(sha1)
+            dst.write(data)
+            trace_count("bytes_written", len(data))
+    replace_working_file(filename, write)
+
+
+# Write bytes to a file in the working directory, the same way
+def write_data_to(data, filename):
+    replace_working_file(filename, lambda dst: dst.write(data))
+    trace_count("bytes_written", len(data))
+
+
+# Call write with a temporary file next to filename, then rename it over filename
+def replace_working_file(filename, write):
+    directory, name = os.path.split(filename)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    tmp = os.path.join(directory, f".mygit-tmp-{os.getpid()}-{name}")
+    try:
+        mode = os.stat(filename).st_mode & 0o7777
+    except FileNotFoundError:
+        mode = None
+    try:
+        with open(tmp, "wb") as dst:
+            write(dst)
+        # Keep the mode of the file being replaced, like writing over it did
+        if mode is not None:
+            os.chmod(tmp, mode)
+        os.replace(tmp, filename)
+    except BaseException:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+        raise
+
+
+# Chunked blobs
+# With chunk-threshold set, files of at least that many bytes are stored as
+# chunks instead of one blob, so changing part of a big file only stores
+# the chunks that changed. Chunks are cut where the content says to, not
+# at fixed offsets, so inserting bytes only changes the chunks around the
+# insert instead of shifting every chunk after it.
+#
+# A chunk ends where a buzhash of the last CHUNK_WINDOW bytes has its low
+# bits all zero. There are enough of them that chunks come out around
+# chunk-size on average, and chunks are kept between a quarter and four
+# times chunk-size. The hash is a CHUNK_WINDOW byte word that is rotated a
+# byte and XORed with a table entry for each byte, so byte g of the hash
+# at position i is the XOR over the window of byte (g - k) of the entry of
+# byte i - k. Each byte of the entries is one bytes.translate of a block,
+# and turned into a big int with a byte per position, the hash of every
+# position in the block is a few shifts and XORs of those ints instead of
+# a Python loop over the bytes.
+#
+# Each chunk is stored as an ordinary blob, and the file's sha1 names a
+# manifest in .mygit/objects/manifests listing its chunks:
+#   chunks <total size>
+#   <chunk sha1> <chunk size>
+# Files are read in CHUNK_READ_SIZE pieces, so memory use doesn't grow
+# with the size of the file
+CHUNK_READ_SIZE = 8 << 20
+CHUNK_WINDOW = 16
+
+
+def manifest_path(sha1):
+    return shard_path(manifests_dir, sha1, sha1[:2])
+
+
+# Every manifest as (sha1, path)
+def loose_manifests():
+    if not os.path.isdir(manifests_dir):
+        return
+    for shard in os.listdir(manifests_dir):
+        shard_dir = os.path.join(manifests_dir, shard)
+        if len(shard) == 2 and os.path.isdir(shard_dir):
+            for name in os.listdir(shard_dir):
+                if len(name) == 40:
+                    yield name, os.path.join(shard_dir, name)
+
+
+# The size threshold for chunking (None if it's off) and the chunk size
+def chunk_config():
+    threshold = get_config("chunk-threshold")
+    chunk_size = get_config("chunk-size", 1 << 20)
+    try:
+        threshold = int(threshold) if threshold else None
+    except ValueError:
+        config_error("chunk-threshold", threshold)
+    try:
+        chunk_size = max(64, int(chunk_size))
+    except ValueError:
+        config_error("chunk-size", chunk_size)
+    return threshold, chunk_size
+
+
+# Returns (total size, [(chunk sha1, size)]), or None if the blob isn't chunked
+def read_manifest(sha1):
+    path = manifest_path(sha1)
+    if not os.path.exists(path):
+        return None
+    with open(path, "r") as file:
+        size = int(file.readline().split()[1])
+        chunks = [(chunk_sha1, int(chunk_size)) for chunk_sha1, chunk_size in (line.split() for line in file)]
+    return size, chunks
+
+
+# The buzhash table, as one bytes.translate table for each byte of the entries
+@functools.lru_cache(maxsize=None)
+def _chunk_tables():
+    entries = [hashlib.sha256(b"mygit chunk %d" % value).digest()[:CHUNK_WINDOW] for value in range(256)]
+    return [bytes(entry[byte] for entry in entries) for byte in range(CHUNK_WINDOW)]
+
+
+# Find the first chunk end in [low, high) whose hash has its low bits all
+# zero, or None. The hash for an end covers the CHUNK_WINDOW bytes before it,
+# which must be in data. Blocks of step ends are hashed at a time, so a
+# boundary near low doesn't cost hashing all the way to high
+def _chunk_boundary(data, low, high, bits, step):
+    tables = _chunk_tables()
+    groups = (bits + 7) // 8
+    last_mask = (1 << (bits - 8 * (groups - 1))) - 1
+    start = low
+    while start < high:
+        end = min(high, start + step)
+        block = data[start - CHUNK_WINDOW:end - 1]
+        length = len(block) + 2 * CHUNK_WINDOW
+        lanes = [int.from_bytes(block.translate(table), "little") for table in tables]
+
+        # Byte 0 of the hash, then each next byte from the one before
+        hash_byte = 0
+        for k in range(CHUNK_WINDOW):
+            hash_byte ^= lanes[-k] << (8 * k)
+        nonzero = 0
+        for group in range(groups):
+            if group:
+                lane = lanes[group]
+                hash_byte = lane ^ (lane << (8 * CHUNK_WINDOW)) ^ (hash_byte << 8)
+            if group == groups - 1:
+                hash_byte &= int.from_bytes(bytes([last_mask]) * length, "little")
+            nonzero |= hash_byte
+
+        found = nonzero.to_bytes(length, "little").find(b"\0", CHUNK_WINDOW - 1, len(block))
+        if found >= 0:
+            return start - CHUNK_WINDOW + found + 1
+        start = end
+    return None
+
+
+# Split the contents of a file into chunks of about chunk_size bytes
+def iter_chunks(file, chunk_size):
+    import math
+    min_size = max(CHUNK_WINDOW, chunk_size // 4)
+    max_size = chunk_size * 4
+    # Each position is a boundary with odds 1 in 2 ** bits
+    bits = max(1, round(math.log2(max(2, chunk_size - min_size))))
+    step = max(CHUNK_WINDOW, chunk_size // 8)
+
+    buffer = bytearray()
+    start = 0
+    eof = False
+    while True:
+        while not eof and len(buffer) - start < max_size:
+            data = file.read(CHUNK_READ_SIZE)
+            if not data:
+                eof = True
+                break
+            del buffer[:start]
+            start = 0
+            buffer += data
+        if len(buffer) == start:
+            return
+
+        end = None
+        if len(buffer) - start > min_size:
+            end = _chunk_boundary(buffer, start + min_size, min(start + max_size, len(buffer)), bits, step)
+        if end is None:
+            end = min(start + max_size, len(buffer))
+        yield bytes(buffer[start:end])
+        start = end
+
+
+# Store a file as chunks and a manifest under the file's sha1
+# Chunks that are already stored, from this file or any other, are shared
+def store_chunked(filename, sha1, chunk_size):
+    lines = []
+    size = 0
+    with open(filename, "rb") as file:
+        for chunk in iter_chunks(file, chunk_size):
+            chunk_sha1 = hashlib.sha1(chunk).hexdigest()
+            lines.append(f"{chunk_sha1} {len(chunk)}\n")
+            size += len(chunk)
+            trace_count("bytes_read", len(chunk))
+            if blob_exists(chunk_sha1):
+                continue
+            path = blob_path(chunk_sha1)
+            make_shard_dir(path)
+            with open(path + ".tmp", "wb") as out:
+                out.write(chunk)
+            os.replace(path + ".tmp", path)
+            wrote_object(path)
+            trace_count("bytes_written", len(chunk))
+
+    # The manifest is written last, so it only exists once all its chunks do
+    path = manifest_path(sha1)
+    make_shard_dir(path)
+    with open(path + ".tmp", "w") as file:
+        file.write(f"chunks {size}\n")
+        file.writelines(lines)
+    os.replace(path + ".tmp", path)
+    wrote_object(path)
+
+
+# Deltas
+# A delta is the size of the base and the result, followed by instructions
+# that either copy a range of the base or insert new bytes:
+#   0 length data   insert
+#   1 offset length copy
+DELTA_INSERT = 0
+DELTA_COPY = 1
+
+# Copies shorter than this cost more than inserting the bytes
+MIN_DELTA_COPY = 8
+
+
+def _write_varint(out, value):
+    while value >= 0x80:
+        out.append((value & 0x7f) | 0x80)
+        value >>= 7
+    out.append(value)
+
+
+def _read_varint(data, pos):
+    value = shift = 0
+    while True:
+        byte = data[pos]
+        pos += 1
+        value |= (byte & 0x7f) << shift
+        shift += 7
+        if byte < 0x80:
+            return value, pos
+
+
+# Make a delta that turns base into target
+# Lines of the base are indexed by content, then each line of the target
+# that appears in the base starts a copy which is extended for as long as
+# the following lines match. This works best for text, which is what
+# usually gets edited over and over
+def make_delta(base, target):
+    base_lines = base.splitlines(keepends=True)
+    target_lines = target.splitlines(keepends=True)
+
+    base_offsets = []
+    first_seen = {}
+    offset = 0
+    for number, line in enumerate(base_lines):
+        base_offsets.append(offset)
+        first_seen.setdefault(line, number)
+        offset += len(line)
+
+    out = bytearray()
+    _write_varint(out, len(base))
+    _write_varint(out, len(target))
+    pending = []
+
+    def flush_insert():
+        if pending:
+            data = b"".join(pending)
+            out.append(DELTA_INSERT)
+            _write_varint(out, len(data))
+            out.extend(data)
+            pending.clear()
+
+    i = 0
+    while i < len(target_lines):
+        j = first_seen.get(target_lines[i])
+        if j is None:
+            pending.append(target_lines[i])
+            i += 1
+            continue
+        start = i
+        copy_offset = base_offsets[j]
+        copy_length = 0
+        while i < len(target_lines) and j < len(base_lines) and target_lines[i] == base_lines[j]:
+            copy_length += len(target_lines[i])
+            i += 1
+            j += 1
+        if copy_length < MIN_DELTA_COPY:
+            pending.extend(target_lines[start:i])
+            continue
+        flush_insert()
+        out.append(DELTA_COPY)
+        _write_varint(out, copy_offset)
+        _write_varint(out, copy_length)
+    flush_insert()
+    return bytes(out)
+
+
+# Rebuild the target of a delta from its base
+def apply_delta(base, delta):
+    base_size, pos = _read_varint(delta, 0)
+    result_size, pos = _read_varint(delta, pos)
+    if base_size != len(base):
+        raise ValueError("delta does not match its base")
+    out = bytearray()
+    while pos < len(delta):
+        op = delta[pos]
+        pos += 1
+        if op == DELTA_COPY:
+            offset, pos = _read_varint(delta, pos)
+            length, pos = _read_varint(delta, pos)
+            out += base[offset:offset + length]
+        else:
+            length, pos = _read_varint(delta, pos)
+            out += delta[pos:pos + length]
+            pos += length
+    if len(out) != result_size:
+        raise ValueError("delta produced the wrong size")
+    return bytes(out)
+
+
+# Commits
+# Commits never change once written, so parsed commits are kept in an LRU
+# cache, and every command loads them through load_commit. With MYGIT_DEBUG
+# set, the hits and misses of the commit and tree caches are printed to
+# stderr when the process exits
+COMMIT_CACHE_SIZE = 4096
+
+
+class Commit:
+    __slots__ = ("id", "parents", "message", "timestamp", "tree", "files")
+
+    def __init__(self, commit_id, data):
+        self.id = str(commit_id)
+        self.parents = tuple(
+            str(data[key]) for key in ("parent", "parent2")
+            if data.get(key) is not None and data.get(key) != ""
+        )
+        self.message = data.get("message", "")
+        self.timestamp = data.get("timestamp", "")
+        self.tree = data.get("tree")
+        # Only commits made before trees existed list their files
+        self.files = None
+        if self.tree is None:
+            self.files = {sys.intern(file): sha1 for file, sha1 in data.get("files", {}).items()}
+
+
+@functools.lru_cache(maxsize=COMMIT_CACHE_SIZE)
+@traced("load_commit")
+def _read_commit(commit_id):
+    import json
+    with open(commit_path(commit_id), "r") as file:
+        data = file.read()
+    trace_count("bytes_read", len(data))
+    trace_count("commits_parsed")
+    return Commit(commit_id, json.loads(data))
+
+
+# Load a commit, or None if there is no commit id
+def load_commit(commit_id):
+    if commit_id is None or commit_id == "":
+        return None
+    return _read_commit(str(commit_id))
+
+
+def _report_caches():
+    if not get_config("debug"):
+        return
+    for name, cached in (("commit", _read_commit), ("tree", read_tree)):
+        info = cached.cache_info()
+        print(f"mygit: {name} cache: {info.hits} hits, {info.misses} misses", file=sys.stderr)
+
+
+atexit.register(_report_caches)
+
+
+# Commit graph
+# Parsing a commit JSON just to find its parents is slow on long histories,
+# so the parents and generation number of every commit are also kept in a
+# binary file with one fixed-width record per commit. Commit ids are
+# numbered from 0 without gaps, so record n is at a fixed offset.
+#
+#   header  "MCGR" version count
+#   records parent (-1 if none) parent2 (-1 if none) generation
+#
+# The generation of a root commit is 1, and every other commit's is one
+# more than the biggest generation of its parents. A commit can only be an
+# ancestor of commits with a bigger generation. A generation of 0 means the
+# commit doesn't exist.
+GRAPH_HEADER = struct.Struct(">4sII")
+GRAPH_RECORD = struct.Struct(">iiI")
+
+# Load the records of the commit graph
+def load_commit_graph():
+    return read_parsed(commit_graph_file, _parse_commit_graph)
+
+
+def _parse_commit_graph(path):
+    if not os.path.exists(path):
+        return b""
+    with open(path, "rb") as file:
+        data = file.read()
+    if len(data) < GRAPH_HEADER.size:
+        return b""
+    magic, version, count = GRAPH_HEADER.unpack_from(data)
+    end = GRAPH_HEADER.size + count * GRAPH_RECORD.size
+    if magic != b"MCGR" or version != 1 or len(data) < end:
+        return b""
+    return data[GRAPH_HEADER.size:end]
+
+
+def _graph_record(commit_id):
+    graph = load_commit_graph()
+    number = int(commit_id)
+    if 0 <= number and (number + 1) * GRAPH_RECORD.size <= len(graph):
+        record = GRAPH_RECORD.unpack_from(graph, number * GRAPH_RECORD.size)
+        if record[2] != 0:
+            return record
+    return None
+
+
+# Read the parents of a commit from its JSON file
+def _json_parents(commit_id):
+    return list(load_commit(commit_id).parents)
+
+
+# Get the parents of a commit as a list of commit ids
+def commit_parents(commit_id):
+    record = _graph_record(commit_id)
+    if record is None:
+        return _json_parents(commit_id)
+    return [str(parent) for parent in record[:2] if parent >= 0]
+
+
+# Get the generation number of a commit
+def commit_generation(commit_id):
+    record = _graph_record(commit_id)
+    if record is not None:
+        return record[2]
+
+    # Not in the graph yet, so work it out from the JSON files
+    generations = {}
+    stack = [str(commit_id)]
+    while stack:
+        node = stack[-1]
+        if node in generations:
+            stack.pop()
+            continue
+        record = _graph_record(node)
+        if record is not None:
+            generations[node] = record[2]
+            stack.pop()
+            continue
+        parents = _json_parents(node)
+        missing = [parent for parent in parents if parent not in generations]
+        if missing:
+            stack.extend(missing)
+            continue
+        generations[node] = 1 + max((generations[parent] for parent in parents), default=0)
+        stack.pop()
+    return generations[str(commit_id)]
+
+
+# Add commits to the end of the commit graph, up to and including commit_id
+# Called after every commit and merge, and catches up on any commits made
+# before the graph existed. The new graph is written to a temporary file
+# and renamed over the old one, so an interrupted update leaves the old
+# graph as it was. That rewrites every record each time, but records are
+# 12 bytes and load_commit_graph has already read the whole file, so it
+# costs about as much as the read every command that uses the graph does
+def update_commit_graph(commit_id):
+    count = len(load_commit_graph()) // GRAPH_RECORD.size
+    new_records = bytearray()
+    generations = {}
+    for number in range(count, int(commit_id) + 1):
+        if commit_exists(number):
+            parents = [int(parent) for parent in _json_parents(number)]
+            generation = 1 + max(
+                (generations.get(parent) or commit_generation(parent) for parent in parents),
+                default=0
+            )
+        else:
+            parents = []
+            generation = 0
+        generations[number] = generation
+        parents += [-1] * (2 - len(parents))
+        new_records += GRAPH_RECORD.pack(parents[0], parents[1], generation)
+    if not new_records:
+        return
+
+    os.makedirs(os.path.dirname(commit_graph_file), exist_ok=True)
+    tmp = commit_graph_file + ".tmp"
+    with open(tmp, "wb") as file:
+        file.write(GRAPH_HEADER.pack(b"MCGR", 1, count + len(new_records) // GRAPH_RECORD.size))
+        file.write(load_commit_graph()[:count * GRAPH_RECORD.size])
+        file.write(new_records)
+    os.replace(tmp, commit_graph_file)
+    forget_parsed(commit_graph_file)
+    wrote_object(commit_graph_file)
+
+
+# Check if ancestor can be reached from descendant by following parents
+# Commits with a smaller generation than the ancestor can't lead to it,
+# so they aren't searched
+def is_ancestor(ancestor, descendant):
+    ancestor = str(ancestor)
+    descendant = str(descendant)
+    if ancestor == descendant:
+        return True
+    if not ancestor or not descendant:
+        return False
+    ancestor_generation = commit_generation(ancestor)
+    seen = {descendant}
+    stack = [descendant]
+    while stack:
+        node = stack.pop()
+        for parent in commit_parents(node):
+            if parent == ancestor:
+                return True
+            if parent in seen or commit_generation(parent) < ancestor_generation:
+                continue
+            seen.add(parent)
+            stack.append(parent)
+    return False
+
+
+# Merge bases
+# The merge bases of two commits are their best common ancestors, the
+# ones that aren't an ancestor of another common ancestor. Both sides
+# are walked at once, newest generation first, painting every commit
+# with the side(s) it can be reached from. A commit reached from both
+# sides is a common ancestor, and everything below it is painted stale.
+# The walk stops as soon as only stale commits are left to visit.
+_SIDE_ONE = 1
+_SIDE_TWO = 2
+_STALE = 4
+
+
+def _paint_down_to_common(ones, twos):
+    import heapq
+    flags = {}
+    queue = []
+
+    def push(commit_id, paint):
+        flags[commit_id] = flags.get(commit_id, 0) | paint
+        heapq.heappush(queue, (-commit_generation(commit_id), -int(commit_id), commit_id))
+
+    for commit_id in ones:
+        push(commit_id, _SIDE_ONE)
+    for commit_id in twos:
+        push(commit_id, _SIDE_TWO)
+
+    common = []
+    while any(not flags[commit_id] & _STALE for _, _, commit_id in queue):
+        _, _, commit_id = heapq.heappop(queue)
+        paint = flags[commit_id] & (_SIDE_ONE | _SIDE_TWO | _STALE)
+        if paint & (_SIDE_ONE | _SIDE_TWO) == _SIDE_ONE | _SIDE_TWO:
+            if not paint & _STALE:
+                if commit_id not in common:
+                    common.append(commit_id)
+                paint |= _STALE
+        for parent in commit_parents(commit_id):
+            if flags.get(parent, 0) & paint == paint:
+                continue
+            push(parent, paint)
+    return common
+
+
+# Get the merge bases of two groups of commits, best first
+# Usually each group is one commit, but a group of several commits acts
+# like a virtual commit that has all of them as parents
+@traced("merge_bases")
+def merge_bases(ones, twos):
+    ones = [str(commit_id) for commit_id in ones if commit_id not in (None, "")]
+    twos = [str(commit_id) for commit_id in twos if commit_id not in (None, "")]
+    if not ones or not twos:
+        return []
+    if set(ones) & set(twos):
+        return sorted(set(ones) & set(twos), key=int, reverse=True)
+
+    common = _paint_down_to_common(ones, twos)
+    # A common ancestor found early can still be an ancestor of one found later
+    bases = [
+        commit_id for commit_id in common
+        if not any(other != commit_id and is_ancestor(commit_id, other) for other in common)
+    ]
+    return sorted(bases, key=lambda commit_id: (commit_generation(commit_id), int(commit_id)), reverse=True)
+
+
+# Turn a branch name or a commit number into a commit id
+# Returns None for unknown names and for branches with no commits
+def resolve_commit(name):
+    if name.isdigit():
+        return name if commit_exists(name) else None
+    return read_branch(name) or None
+
+
+# Get the root tree of a commit, or None if there is no commit
+# Commits made before trees existed list their files instead, and get
+# their tree stored the first time it's asked for
+def commit_tree(commit_id):
+    if commit_id is None or commit_id == "":
+        return None
+    commit = load_commit(commit_id)
+    if commit.tree is None:
+        commit.tree = write_tree(commit.files)
+    return commit.tree
+
+
+# Load the {filename: sha1} map of a commit
+def load_commit_files(commit_id):
+    if commit_id is None or commit_id == "":
+        return {}
+    commit = load_commit(commit_id)
+    if commit.files is not None:
+        return dict(commit.files)
+    return tree_files(commit.tree)
+
+
+# Everything reachable from a branch, the index or a merge waiting for its
+# conflicts to be fixed, as sets of commit ids, tree sha1s, blob sha1s and
+# manifest sha1s. The chunks of chunked blobs count as blobs
+def reachable_objects(index_path):
+    commits = set()
+    trees = set()
+    blobs = set()
+
+    def mark_tree(sha1):
+        if sha1 in trees:
+            return
+        trees.add(sha1)
+        for kind, entry_sha1, _ in read_tree(sha1):
+            if kind == "tree":
+                mark_tree(entry_sha1)
+            else:
+                blobs.add(entry_sha1)
+
+    index_map, _ = read_index(index_path)
+    blobs.update(index_map.values())
+
+    stack = [read_branch(branch) for branch in list_branches()] + [read_merge_head()]
+    while stack:
+        commit_id = stack.pop()
+        if not commit_id or commit_id in commits:
+            continue
+        commits.add(commit_id)
+        commit = load_commit(commit_id)
+        if commit.tree is not None:
+            mark_tree(commit.tree)
+        else:
+            # A commit from before trees lists its files, and commit_tree
+            # stores trees for it the first time it's asked for one
+            blobs.update(commit.files.values())
+            trees.update(sha1 for sha1 in build_trees(commit.files)[1] if os.path.exists(tree_path(sha1)))
+        stack.extend(commit.parents)
+
+    manifests = set()
+    for sha1 in list(blobs):
+        manifest = read_manifest(sha1)
+        if manifest is not None:
+            manifests.add(sha1)
+            blobs.update(chunk_sha1 for chunk_sha1, _ in manifest[1])
+    return commits, trees, blobs, manifests
+
+
+# Decide what happens to one file in a three-way merge, given its sha1 in the
+# origin (o), the current commit (c) and the target commit (t), where None
+# means the file doesn't exist. Returns ("ok", sha1), ("delete", None) or
+# ("conflict", None)
+def decide(o, c, t):
+    if c == t:
+        return ("delete", None) if c is None else ("ok", c)
+    if o is not None:
+        if c == o and t != o:
+            return ("ok", t)
+        if c != o and t == o:
+            return ("ok", c)
+        if c is None and t == o:
+            return ("delete", None)
+        if t is None and c == o:
+            return ("delete", None)
+        return ("conflict", None)
+    else:
+        if c is None and t is None:
+            return ("delete", None)
+        if c is None and t is not None:
+            return ("ok", t)
+        if t is None and c is not None:
+            return ("ok", c)
+        return ("conflict", None)
+
+
+# Merge three {filename: sha1} maps
+# Returns the merged map and the set of files that conflict
+# If we already know which files differ between current and target, only
+# those need deciding, since every other file stays as it is in current
+def merge_file_maps(origin, current, target, changed=None):
+    if changed is None:
+        changed = set(current) | set(target) | set(origin)
+    merged = {file: sha1 for file, sha1 in current.items() if file not in changed}
+    conflict = set()
+    for file in sorted(changed):
+        status, sha1 = decide(origin.get(file), current.get(file), target.get(file))
+        if status == "ok" and sha1 is not None:
+            merged[file] = sha1
+        elif status == "conflict":
+            conflict.add(file)
+    return merged, conflict
+
+
+# The files of the origin to use when merging, given the merge bases
+# With one merge base that is just its files. With several, the bases are
+# merged together into a virtual base first, recursively using their own
+# merge bases. A file that conflicts in the virtual base gets a placeholder
+# that matches neither side, so it conflicts again unless both sides agree
+def merge_base_files(bases):
+    if not bases:
+        return {}
+    files = load_commit_files(bases[0])
+    merged_ids = [bases[0]]
+    for other in bases[1:]:
+        inner_files = merge_base_files(merge_bases(merged_ids, [other]))
+        files, conflict = merge_file_maps(inner_files, files, load_commit_files(other))
+        for file in conflict:
+            files[file] = "conflict"
+        merged_ids.append(other)
+    return files
+
+
+# Switching the working directory
+# Change the working files from the snapshot of one commit to another
+# Only files whose content is different in the two snapshots are written
+# or removed, so files that stay the same keep their mtime and their stat
+# data in the index. Tracked files missing from the working directory are
+# written back as well
+# Returns the stat data for the target's files, and the number of files
+# written and removed
+@traced("switch_files")
+def switch_files(current_id, target_id, stats):
+    target_files = load_commit_files(target_id)
+    changed = {
+        file: sha1
+        for file, _, sha1 in diff_trees(commit_tree(current_id), commit_tree(target_id))
+    }
+
+    removed = 0
+    for file, sha1 in sorted(changed.items()):
+        if sha1 is None and os.path.exists(file):
+            remove_working_file(file)
+            removed += 1
+
+    target_stats = {}
+    written = 0
+    for file, sha1 in sorted(target_files.items()):
+        if file not in changed and os.path.exists(file):
+            if file in stats:
+                target_stats[file] = stats[file]
+            continue
+        write_blob_to(sha1, file)
+        target_stats[file] = file_stat(file)
+        written += 1
+    return target_stats, written, removed
+
+
+# Print how many files a command wrote and removed, if MYGIT_VERBOSE is set
+def report_switch(written, removed):
+    if get_config("verbose"):
+        print(f"{written} files written, {removed} files removed", file=sys.stderr)
+
+
+# Line diffs
+# Lines are hashed once into small integers, the same integer for the same
+# line in either file, and the diff runs on the two integer lists. Lines
+# the two ends have in common are found by comparing whole slices, which
+# Python does in C, and only what's left between them goes through Myers'
+# O(ND) algorithm. It finds the middle snake of the shortest edit script
+# by searching from both ends, then recurses on each side of it, so memory
+# stays linear in the number of lines
+
+# Split a file into lines, each keeping its "\n"
+def split_lines(data):
+    lines = data.split(b"\n")
+    if lines[-1] == b"":
+        lines.pop()
+        return [line + b"\n" for line in lines]
+    return [line + b"\n" for line in lines[:-1]] + [lines[-1]]
+
+
+def line_ids(*files):
+    ids = {}
+    return [[ids.setdefault(line, len(ids)) for line in lines] for lines in files]
+
+
+# How many items a[a_lo:] and b[b_lo:] have in common at the start, or at
+# the end if backwards, looking at no more than limit items
+def _common_run(a, a_lo, b, b_lo, limit, backwards=False):
+    run = 0
+    step = 64
+    while run < limit:
+        step = min(step, limit - run)
+        if backwards:
+            same = a[a_lo - run - step:a_lo - run] == b[b_lo - run - step:b_lo - run]
+        else:
+            same = a[a_lo + run:a_lo + run + step] == b[b_lo + run:b_lo + run + step]
+        if same:
+            run += step
+            step *= 2
+        elif step == 1:
+            break
+        else:
+            step //= 2
+    return run
+
+
+def _middle_snake(a, a_lo, a_hi, b, b_lo, b_hi):
+    n = a_hi - a_lo
+    m = b_hi - b_lo
+    delta = n - m
+    odd = delta & 1
+    limit = (n + m + 1) // 2
+    offset = limit + 1
+    forward = [0] * (2 * offset + 1)
+    backward = [0] * (2 * offset + 1)
+    for d in range(limit + 1):
+        for k in range(-d, d + 1, 2):
+            if k == -d or (k != d and forward[offset + k - 1] < forward[offset + k + 1]):
+                x = forward[offset + k + 1]
+            else:
+                x = forward[offset + k - 1] + 1
+            y = x - k
+            start_x, start_y = x, y
+            while x < n and y < m and a[a_lo + x] == b[b_lo + y]:
+                x += 1
+                y += 1
+            forward[offset + k] = x
+            if odd and delta - d < k < delta + d and x + backward[offset + delta - k] >= n:
+                return a_lo + start_x, b_lo + start_y, a_lo + x, b_lo + y
+        for k in range(-d, d + 1, 2):
+            if k == -d or (k != d and backward[offset + k - 1] < backward[offset + k + 1]):
+                x = backward[offset + k + 1]
+            else:
+                x = backward[offset + k - 1] + 1
+            y = x - k
+            start_x, start_y = x, y
+            while x < n and y < m and a[a_hi - 1 - x] == b[b_hi - 1 - y]:
+                x += 1
+                y += 1
+            backward[offset + k] = x
+            if not odd and -d <= delta - k <= d and x + forward[offset + delta - k] >= n:
+                return a_hi - x, b_hi - y, a_hi - start_x, b_hi - start_y
+    raise AssertionError("no middle snake")
+
+
+def _diff_blocks(a, a_lo, a_hi, b, b_lo, b_hi, blocks):
+    prefix = _common_run(a, a_lo, b, b_lo, min(a_hi - a_lo, b_hi - b_lo))
+    if prefix:
+        blocks.append((a_lo, b_lo, prefix))
+        a_lo += prefix
+        b_lo += prefix
+    suffix = _common_run(a, a_hi, b, b_hi, min(a_hi - a_lo, b_hi - b_lo), backwards=True)
+    a_hi -= suffix
+    b_hi -= suffix
+    if a_lo < a_hi and b_lo < b_hi:
+        x, y, u, v = _middle_snake(a, a_lo, a_hi, b, b_lo, b_hi)
+        _diff_blocks(a, a_lo, x, b, b_lo, y, blocks)
+        if u > x:
+            blocks.append((x, y, u - x))
+        _diff_blocks(a, u, a_hi, b, v, b_hi, blocks)
+    if suffix:
+        blocks.append((a_hi, b_hi, suffix))
+
+
+def _add_block(blocks, i, j, size):
+    if blocks and blocks[-1][0] + blocks[-1][2] == i and blocks[-1][1] + blocks[-1][2] == j:
+        blocks[-1] = (blocks[-1][0], blocks[-1][1], blocks[-1][2] + size)
+    else:
+        blocks.append((i, j, size))
+
+
+# The runs of lines two lists of line ids have in common, in order, as
+# (start in a, start in b, length), like difflib's get_matching_blocks
+# without the sentinel at the end
+# A line that isn't in the other file at all can't match anything, so those
+# are left out before diffing, which keeps files that were mostly rewritten
+# from costing O(N^2). The blocks are then mapped back to the whole files
+def matching_blocks(a, b):
+    common = set(a).intersection(b)
+    keep_a = [i for i, line in enumerate(a) if line in common]
+    keep_b = [j for j, line in enumerate(b) if line in common]
+    if len(keep_a) == len(a) and len(keep_b) == len(b):
+        blocks = []
+        _diff_blocks(a, 0, len(a), b, 0, len(b), blocks)
+        merged = []
+        for i, j, size in blocks:
+            _add_block(merged, i, j, size)
+        return merged
+
+    blocks = []
+    _diff_blocks([a[i] for i in keep_a], 0, len(keep_a), [b[j] for j in keep_b], 0, len(keep_b), blocks)
+    merged = []
+    for i, j, size in blocks:
+        for k in range(size):
+            _add_block(merged, keep_a[i + k], keep_b[j + k], 1)
+    return merged
+
+
+# The changes between two lists of line ids as (a_start, a_end, b_start, b_end),
+# where lines a[a_start:a_end] are replaced by b[b_start:b_end]
+@traced("diff")
+def diff_ranges(a, b):
+    changes = []
+    i = j = 0
+    for a_start, b_start, size in matching_blocks(a, b) + [(len(a), len(b), 0)]:
+        if i < a_start or j < b_start:
+            changes.append((i, a_start, j, b_start))
+        i, j = a_start + size, b_start + size
+    return changes
+
+
+# Line merges
+# A file both sides of a merge changed is merged line by line, like diff3.
+# Each side is diffed against the origin, and the lines of the origin that
+# neither side touched split all three files into regions. Between those,
+# a region only one side changed takes that side's lines, a region both
+# sides changed the same way takes those lines, and anything else is a
+# conflict and gets both sides between markers
+MERGE_BINARY_CHECK_SIZE = 8000
+
+
+# The regions where the origin lines o[o_start:o_end] are unchanged in both
+# sides, as (o_start, o_end, a_start, a_end, b_start, b_end), ending with
+# an empty region at the end of all three
+def _sync_regions(o, a, b):
+    a_blocks = matching_blocks(o, a)
+    b_blocks = matching_blocks(o, b)
+    regions = []
+    i = j = 0
+    while i < len(a_blocks) and j < len(b_blocks):
+        a_o, a_start, a_size = a_blocks[i]
+        b_o, b_start, b_size = b_blocks[j]
+        start = max(a_o, b_o)
+        end = min(a_o + a_size, b_o + b_size)
+        if start < end:
+            a_at = a_start + start - a_o
+            b_at = b_start + start - b_o
+            regions.append((start, end, a_at, a_at + end - start, b_at, b_at + end - start))
+        if a_o + a_size < b_o + b_size:
+            i += 1
+        else:
+            j += 1
+    regions.append((len(o), len(o), len(a), len(a), len(b), len(b)))
+    return regions
+
+
+# Merge three lists of lines, where the lines of a and b are changed
+# copies of origin. labels name a and b in conflict markers
+# Returns the merged lines and the number of conflicts
+def merge_lines(origin, a, b, labels):
+    o_ids, a_ids, b_ids = line_ids(origin, a, b)
+    merged = []
+    conflicts = 0
+    o_at = a_at = b_at = 0
+    for o_start, o_end, a_start, a_end, b_start, b_end in _sync_regions(o_ids, a_ids, b_ids):
+        if o_at < o_start or a_at < a_start or b_at < b_start:
+            o_region = o_ids[o_at:o_start]
+            a_region = a_ids[a_at:a_start]
+            b_region = b_ids[b_at:b_start]
+            if a_region == b_region or b_region == o_region:
+                merged.extend(a[a_at:a_start])
+            elif a_region == o_region:
+                merged.extend(b[b_at:b_start])
+            else:
+                # Lines both sides start or end the region with aren't
+                # part of the conflict, so they go outside the markers
+                limit = min(len(a_region), len(b_region))
+                head = _common_run(a_region, 0, b_region, 0, limit)
+                tail = _common_run(a_region, len(a_region), b_region, len(b_region), limit - head, backwards=True)
+                conflicts += 1
+                merged.extend(a[a_at:a_at + head])
+                for marker, lines in (
+                    (f"<<<<<<< {labels[0]}\n", a[a_at + head:a_start - tail]),
+                    ("=======\n", b[b_at + head:b_start - tail]),
+                ):
+                    merged.append(marker.encode())
+                    merged.extend(lines)
+                    if lines and not lines[-1].endswith(b"\n"):
+                        merged[-1] += b"\n"
+                merged.append(f">>>>>>> {labels[1]}\n".encode())
+                merged.extend(a[a_start - tail:a_start])
+        merged.extend(a[a_start:a_end])
+        o_at, a_at, b_at = o_end, a_end, b_end
+    return merged, conflicts
+
+
+# Merge the contents of a file that both sides changed, given the sha1 of
+# each version, with origin None if the file wasn't in the origin
+# Returns (contents, number of conflicts), or None if any version is binary
+@traced("merge_file")
+def merge_blobs(origin, current, target, labels):
+    versions = [read_blob(sha1) if sha1 is not None else b"" for sha1 in (origin, current, target)]
+    if any(b"\0" in data[:MERGE_BINARY_CHECK_SIZE] for data in versions):
+        return None
+    lines, conflicts = merge_lines(*(split_lines(data) for data in versions), labels)
+    return b"".join(lines), conflicts
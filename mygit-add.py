@@ -2,9 +2,7 @@
 
 import os
 import sys
-import shutil
-import re
-from helper import file_sha1sum
+from helper import hash_files, file_stat, open_index, save_index, store_blob, FileLocked, valid_path, scan_working_files
 
 
 # Checking if filenames have been input
@@ -12,11 +10,8 @@ if len(sys.argv) < 2:
     print("usage: mygit-add <filenames>", file=sys.stderr)
     sys.exit(1)
 
-# Regex for valid file
-file_pattern = re.compile(r'^[a-zA-Z0-9][a-zA-Z0-9._-]*$')
 mygit = ".mygit"
 index_file = os.path.join(mygit, "index")
-blobs_dir = os.path.join(mygit, "objects", "blobs")
 
 # Check if repository exists
 if not os.path.isdir(mygit):
@@ -24,37 +19,53 @@ if not os.path.isdir(mygit):
     sys.exit(1)
 
 # Load files and the hash of each file in a dict
-index_data = {}
-if os.path.exists(index_file):
-    with open(index_file, "r") as file:
-        for line in file:
-            name, sha1 = line.strip().split()
-            index_data[name] = sha1
+try:
+    index_data, index_stats = open_index(index_file)
+except FileLocked as error:
+    print(f"mygit-add: error: {error}", file=sys.stderr)
+    sys.exit(1)
 
 
+to_add = []
 for filename in sys.argv[1:]:
-    if not file_pattern.fullmatch(filename):
+    filename = filename.rstrip("/")
+    if not valid_path(filename):
         print(f"mygit-add: error: invalid filename '{filename}'", file=sys.stderr)
         sys.exit(1)
-    
+
+    # A directory adds every file under it that isn't ignored
+    if os.path.isdir(filename):
+        to_add.extend((file, file_stat(file)) for file in sorted(scan_working_files(filename)))
+        continue
+
     # Remove file if it doesn't exist in working directory
     if not os.path.exists(filename):
         if filename in index_data:
             del index_data[filename]
+            index_stats.pop(filename, None)
         else:
             print(f"mygit-add: error: can not open '{filename}'", file=sys.stderr)
             sys.exit(1)
-    # Compute the sha1sum of the file and store it in the dict for now
-    # And add blob file with the file content copied into the blob file
+    # Stat before hashing so a change made while hashing is noticed later
     else:
-        sha1 = file_sha1sum(filename)
-        index_data[filename] = sha1
-        blob_path = os.path.join(blobs_dir, sha1)
-        if not os.path.exists(blob_path):
-            shutil.copy2(filename, blob_path)
+        to_add.append((filename, file_stat(filename)))
+
+# Compute the sha1sum of all the files in one batch and store them in the dict
+# And add blob file with the file content copied into the blob file
+hashes = hash_files(filename for filename, _ in to_add)
+for (filename, stat), sha1 in zip(to_add, hashes):
+    # The file was removed after we listed it
+    if sha1 is None:
+        print(f"mygit-add: error: can not open '{filename}'", file=sys.stderr)
+        sys.exit(1)
+    index_data[filename] = sha1
+    index_stats[filename] = stat
+    store_blob(filename, sha1)
 
 
 # Update the index file with the filename and the sha1sum of the filename
-with open(index_file, "w") as file:
-    for name, sha1 in index_data.items():
-        file.write(f"{name} {sha1}\n")
+try:
+    save_index(index_file, index_data, index_stats)
+except FileLocked as error:
+    print(f"mygit-add: error: {error}", file=sys.stderr)
+    sys.exit(1)
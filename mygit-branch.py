@@ -3,7 +3,10 @@
 import os
 import sys
 import re
-import json
+from helper import (
+    is_ancestor, branch_exists, current_branch, read_branch, write_branch,
+    delete_branch, list_branches, FileLocked
+)
 
 mygit = ".mygit"
 branch_path = "refs/heads"
@@ -12,45 +15,8 @@ head_file = os.path.join(mygit, "HEAD")
 objects_dir = os.path.join(mygit, "objects")
 
 def get_current_commit():
-    with open(head_file, "r") as file:
-        head_content = file.read().strip()
-    branch_path = head_content.replace("ref: ", "")
-    branch_file = os.path.join(mygit, branch_path)
-
-    with open(branch_file, "r") as file:
-        return file.read().strip()
+    return read_branch(current_branch())
     
-def read_branch_commit(branch_file_path):
-    with open(branch_file_path, "r") as file:
-        return file.read().strip()
-def load_parents(commit_id: str):
-    path = os.path.join(objects_dir, f"{commit_id}.json")
-    with open(path, "r") as file:
-        commit_data = json.load(file)
-    parents = []
-    parent1 = commit_data.get("parent")
-    parent2 = commit_data.get("parent2")
-    if parent1 is not None:
-        parents.append(parent1)
-    if parent2 is not None:
-        parents.append(parent2)
-    return parents
-
- # Get the ancestor commit of the current commit in branch
-def is_ancestor(ancestor, current):
-    if ancestor == current:
-        return True
-    seen = set()
-    stack = [current]
-    while stack:
-        node = stack.pop()
-        if node in seen:
-            continue
-        for parent in load_parents(node):
-            if parent == ancestor:
-                return True
-            stack.append(parent)
-    return False
 if not os.path.isdir(mygit):
     print("mygit-branch: error: mygit repository directory .mygit not found", file=sys.stderr)
     sys.exit(1)
@@ -63,16 +29,15 @@ valid_branch = re.compile(r'^[a-zA-Z0-9][a-zA-Z0-9_-]*$')
 
 delete = False
 
-with open(".mygit/refs/heads/trunk", "r") as file:
-    if not file.read().strip():
-        print("mygit-branch: error: this command can not be run until after the first commit", file=sys.stderr)
-        sys.exit(1)
+if not read_branch("trunk"):
+    print("mygit-branch: error: this command can not be run until after the first commit", file=sys.stderr)
+    sys.exit(1)
 
 if len(sys.argv) == 1:
     branches = []
 
     # Print all branches in sorted order
-    for file in os.listdir(branch_dir):
+    for file in list_branches():
         if file != "trunk":
             branches.append(file)
     
@@ -100,7 +65,7 @@ elif len(sys.argv) == 2:
     else:
         if command == options_end_flag:
             branches = []
-            for file in os.listdir(branch_dir):
+            for file in list_branches():
                 if file != "trunk":
                     branches.append(file)
             
@@ -110,13 +75,11 @@ elif len(sys.argv) == 2:
             sys.exit(0)
         else:   
             new_branch = command
-            new_branch_file = os.path.join(branch_dir, new_branch)
-            if os.path.exists(new_branch_file):
+            if branch_exists(new_branch):
                 print(f"mygit-branch: error: branch '{new_branch}' already exists", file=sys.stderr)
                 sys.exit(1)
             current_commit = get_current_commit()
-            with open(new_branch_file, "w") as file:
-                file.write(current_commit)
+            write_branch(new_branch, current_commit)
             sys.exit(0)
 
 elif len(sys.argv) == 3:
@@ -129,12 +92,10 @@ elif len(sys.argv) == 3:
                 sys.exit(1)
             else:
                 new_branch = args[1]
-                new_branch_file = os.path.join(branch_dir, new_branch)
-                if os.path.exists(new_branch_file):
+                if branch_exists(new_branch):
                     print(f"mygit-branch: error: branch '{new_branch}' already exists", file=sys.stderr)
                     sys.exit(1)
-                with open(new_branch_file, "w") as file:
-                    pass
+                write_branch(new_branch, "")
                 sys.exit(0)
         else:
             if flag_check.fullmatch(args[0]):
@@ -148,13 +109,11 @@ elif len(sys.argv) == 3:
                 sys.exit(1)
             else:
                 new_branch = args[0]
-                new_branch_file = os.path.join(branch_dir, new_branch)
-                if os.path.exists(new_branch_file):
+                if branch_exists(new_branch):
                     print(f"mygit-branch: error: branch '{new_branch}' already exists", file=sys.stderr)
                     sys.exit(1)
-                current_commit = current_commit()
-                with open(new_branch_file, "w") as file:
-                    file.write(current_commit)
+                current_commit = get_current_commit()
+                write_branch(new_branch, current_commit)
                 sys.exit(0)
     elif not delete:
         print("usage: mygit-branch [-d] <branch>", file=sys.stderr)
@@ -193,31 +152,28 @@ elif len(sys.argv) == 3:
                 if valid_branch.fullmatch(arg) and not delete_flag.fullmatch(arg))
             )
             branch_delete = args[index]
-            branch_delete_file = os.path.join(branch_dir, branch_delete)
-            if not os.path.exists(branch_delete_file):
+            if not branch_exists(branch_delete):
                 print(f"mygit-branch: error: branch '{branch_delete}' doesn't exist", file=sys.stderr)
                 sys.exit(1)
             if branch_delete == "trunk":
                 print(f"mygit-branch: error: can not delete branch '{branch_delete}': default branch ", file=sys.stderr)
                 sys.exit(1)
             
-            with open(head_file, "r") as file:
-                current_branch = file.read().strip()
-            current_branch_path = current_branch.replace("ref: ", "")
-            current_branch_file = os.path.join(mygit, current_branch_path)
-
-            if os.path.samefile(current_branch_file, branch_delete_file):
+            if branch_delete == current_branch():
                 print(f"mygit-branch: error: can not delete '{branch_delete}': current branch", file=sys.stderr)
                 sys.exit(1)
             current_tip = get_current_commit()
-            with open(branch_delete_file, "r") as file:
-                delete_commit = file.read().strip()
+            delete_commit = read_branch(branch_delete)
             
             if not is_ancestor(delete_commit, current_tip):
                 print(f"mygit-branch: error: branch '{branch_delete}' has unmerged changes", file=sys.stderr)
                 sys.exit(1)
             
-            os.remove(branch_delete_file)
+            try:
+                delete_branch(branch_delete)
+            except FileLocked as error:
+                print(f"mygit-branch: error: {error}", file=sys.stderr)
+                sys.exit(1)
             print(f"Deleted branch '{branch_delete}'")
             sys.exit(0)
 else:
@@ -3,8 +3,11 @@
 import os
 import sys
 import re
-import json
-from helper import file_sha1sum, write_index
+from helper import (
+    read_index, write_index, working_sha1s, commit_tree, load_commit_files, switch_files, report_switch,
+    branch_exists, current_branch, read_branch, set_current_branch, working_tree, save_fsmonitor_token,
+    read_merge_head, lock_file, FileLocked
+)
 
 mygit = ".mygit"
 branch_path = "refs/heads"
@@ -12,50 +15,43 @@ index_file = os.path.join(mygit, "index")
 objects_dir = os.path.join(mygit, "objects")
 branch_dir = os.path.join(mygit, branch_path)
 head_file = os.path.join(mygit, "HEAD")
-valid_file = re.compile(r'^[a-zA-Z0-9][a-zA-Z0-9._-]*$')
 
 
-def get_from_blob(filename, sha1):
-    blob_file = os.path.join(objects_dir, "blobs", sha1)
-    with open(blob_file, "rb") as src, open(filename, "wb") as dst:
-        dst.write(src.read())
-
 def checkout_branch(branch):
-    branch_file = os.path.join(branch_dir, branch)
-    if not os.path.exists(branch_file):
+    if read_merge_head():
+        print("mygit-checkout: error: a merge with conflicts has not been committed yet", file=sys.stderr)
+        sys.exit(1)
+    if not branch_exists(branch):
         print(f"mygit-checkout: error: unknown branch '{branch}'", file=sys.stderr)
         sys.exit(1)
-    with open(head_file, "r") as file:
-        head_content = file.read().strip()
-    current_branch = head_content.replace("ref: ", "")
-    current_branch_file = os.path.join(mygit, current_branch)
-    if os.path.samefile(branch_file, current_branch_file):
+    if branch == current_branch():
         print(f"Already on '{branch}'", file=sys.stderr)
         sys.exit(1)
 
-    with open(branch_file, "r") as file:
-        target_branch_commit_pointer = file.read().strip()
-    
-    with open(current_branch_file, "r") as file:
-        current_branch_commit_pointer = file.read().strip()
+    # Lock the index before reading it, so nothing else changes it before
+    # this command has switched HEAD, the working files and the index
+    try:
+        lock_file(index_file)
+    except FileLocked as error:
+        print(f"mygit-checkout: error: {error}", file=sys.stderr)
+        sys.exit(1)
+
+    target_branch_commit_pointer = read_branch(branch)
+    current_branch_commit_pointer = read_branch(current_branch())
     
-    if current_branch_commit_pointer == target_branch_commit_pointer:
-        with open(head_file, "w") as file:
-            file.write(f"ref: refs/heads/{branch}\n")
+    # Both branches have the same snapshot when their commits have the
+    # same tree, so just like being on the same commit no files change
+    if current_branch_commit_pointer == target_branch_commit_pointer or (
+        commit_tree(current_branch_commit_pointer) == commit_tree(target_branch_commit_pointer)
+    ):
+        set_current_branch(branch)
         print(f"Switched to branch '{branch}'")
         sys.exit(0)
     
-    def load_commit_file(commit_id):
-        commit_file = os.path.join(objects_dir, f"{commit_id}.json")
-        with open(commit_file, "r") as file:
-            return json.load(file).get("files", {})
-        
-    with open(index_file, "r") as file:
-        index_entries = [line.strip().split(None, 1) for line in file if line.strip()]
-    index_map = {filename: sha1 for filename, sha1 in index_entries} if index_entries else {}
-
-    target_commit = load_commit_file(target_branch_commit_pointer)
-    current_commit = load_commit_file(current_branch_commit_pointer)
+    index_map, index_stats = read_index(index_file)
+
+    target_commit = load_commit_files(target_branch_commit_pointer)
+    current_commit = load_commit_files(current_branch_commit_pointer)
 
     diff_index_current_commit = sorted(
         file for file in (set(index_map) | set(current_commit))
@@ -68,15 +64,19 @@ def checkout_branch(branch):
             print(file)
         sys.exit(1)
     
-    working_files = sorted(
-        file for file in os.listdir('.')
-        if os.path.isfile(file) and valid_file.fullmatch(file)
+    # The fsmonitor, if it's running, knows the files and which changed
+    working_files, changed, monitor_token = working_tree(index_map)
+    working_files = sorted(working_files)
+
+    # Untracked files don't need hashing, and tracked files can use
+    # the stat data in the index
+    working_map = working_sha1s(
+        [file for file in working_files if file in index_map],
+        index_map, index_stats, index_file, changed
     )
-    
-    working_map = {f: file_sha1sum(f) for f in working_files}
 
     overwrite = set()
-    for file, sha1 in working_map.items():
+    for file in working_files:
         index_sha1 = index_map.get(file)
         target_sha1 = target_commit.get(file)
 
@@ -84,32 +84,29 @@ def checkout_branch(branch):
             if target_sha1 is not None:
                 overwrite.add(file)
         else:
+            sha1 = working_map.get(file)
             if sha1 != index_sha1:
                 if target_sha1 != sha1:
-                    overwrite(file)
+                    overwrite.add(file)
     if overwrite:
         print("mygit-checkout: error: Your changes to the following files would be overwritten by checkout:", file=sys.stderr)
         for file in sorted(set(overwrite)):
             print(file)
         sys.exit(1)
     
-    previous_tracked = set(index_map.keys()) | set(current_commit.keys())
-    target_set = set(target_commit.keys())
+    set_current_branch(branch)
 
-    
-    with open(head_file, "w") as file:
-        file.write(f"ref: refs/heads/{branch}\n")
-
-    write_index(index_file, target_commit)
+    # The index is the same as the current commit here, so only the files
+    # that differ between the two commits need writing or removing
+    target_stats, written, removed = switch_files(
+        current_branch_commit_pointer, target_branch_commit_pointer, index_stats
+    )
 
-    for file in sorted(previous_tracked - target_set):
-        if valid_file.fullmatch(file) and os.path.exists(file):
-            os.remove(file)
-    
-    for file, sha1 in sorted(target_commit.items()):
-        if valid_file.fullmatch(file):
-            get_from_blob(file, sha1)
+    write_index(index_file, target_commit, target_stats)
+    if monitor_token is not None:
+        save_fsmonitor_token(monitor_token)
     print(f"Switched to branch '{branch}'")
+    report_switch(written, removed)
     sys.exit(0)
 
 
@@ -120,10 +117,9 @@ if not os.path.isdir(mygit):
     print("mygit-checkout: error: mygit repository directory .mygit not found", file=sys.stderr)
     sys.exit(1)
 
-with open(".mygit/refs/heads/trunk", "r") as file:
-    if not file.read().strip():
-        print("mygit-checkout: error: this command can not be run until after the first commit", file=sys.stderr)
-        sys.exit(1)
+if not read_branch("trunk"):
+    print("mygit-checkout: error: this command can not be run until after the first commit", file=sys.stderr)
+    sys.exit(1)
 
 args = sys.argv[1:]
 
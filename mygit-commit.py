@@ -2,11 +2,17 @@
 
 
 import sys
-import shutil
 import os
 from datetime import datetime
 import json
-from helper import file_sha1sum, read_seq, next_commit_id, bump_seq
+from helper import (
+    read_seq, next_commit_id, bump_seq, read_index, write_index, working_sha1s,
+    store_blob, commit_path, make_shard_dir, update_commit_graph, wrote_object,
+    commit_tree, tree_hash, write_tree, diff_trees,
+    current_branch, read_branch, write_branch, query_fsmonitor, save_fsmonitor_token,
+    read_merge_head, write_merge_head, read_merge_conflicts, has_conflict_markers, file_sha1sum,
+    lock_file, FileLocked
+)
 
 mygit = ".mygit"
 index_file = ".mygit/index"
@@ -44,52 +50,90 @@ a_flag = args[0] == "-a"
 if not os.path.exists(index_file):
     open(index_file, "w").close()
 
-with open(index_file, "r") as file:
-    index_entries = [line.strip().split(None, 1) for line in file if line.strip()]
-
-index_map = {filename: sha1 for filename, sha1 in index_entries} if index_entries else {}
+# Lock the index before reading it, so nothing else changes it before
+# this command writes it back
+try:
+    lock_file(index_file)
+except FileLocked as error:
+    print(f"mygit-commit: error: {error}", file=sys.stderr)
+    sys.exit(1)
+index_map, index_stats = read_index(index_file)
 
 
 # If a flag, then update index with all files in working directory
 # including all their changes
 if a_flag:
+    # The fsmonitor, if it's running, knows which files could have changed
+    monitor = query_fsmonitor()
+    tracked = list(index_map)
+    if monitor is not None:
+        monitor_files, changed, monitor_token = monitor
+        # A tracked file the daemon doesn't list is either deleted or in a
+        # directory .mygitignore has it skip, so check it like a changed one
+        if changed is not None:
+            changed |= {file for file in index_map if file not in monitor_files}
+    else:
+        changed = None
+    # Files staged here keep the stat data they were hashed with, like
+    # mygit-add, so the next command doesn't hash them again
+    new_stats = {}
+    working_map = working_sha1s(tracked, index_map, index_stats, index_file, changed, new_stats)
     for filename in list(index_map.keys()):
-        if os.path.isfile(filename):
-            index_map[filename] = file_sha1sum(filename)
+        if filename in working_map:
+            if working_map[filename] != index_map[filename]:
+                index_map[filename] = working_map[filename]
+                index_stats[filename] = new_stats[filename]
         else:
             del index_map[filename]
-    with open(index_file, "w") as file:
-        for fname, sha1 in index_map.items():
-            file.write(f"{fname} {sha1}\n")
+            index_stats.pop(filename, None)
+    write_index(index_file, index_map, index_stats)
+    if monitor is not None:
+        save_fsmonitor_token(monitor_token)
 
 
 current_files = dict(index_map)
 
 # Get current branch
-head_content = None
-with open(".mygit/HEAD", "r") as head_file:
-    head_content = head_file.read().strip()
-
-branch_path = head_content.replace("ref: ", "")
-branch_file = os.path.join(".mygit", branch_path)
+branch = current_branch()
 
 changed = False
 
 # Read the commit that this branch is pointing to
-with open(branch_file, 'r') as file:
-    last_commit = file.read().strip()
+last_commit = read_branch(branch)
+
+# Finishing a merge that had conflicts, which makes a merge commit even if
+# the result is the same as the current commit
+merge_head = read_merge_head()
+
+# A conflicted file has to have its fixed version added before the merge is
+# committed, so refuse while the index still has the version from before the
+# merge or the working file still differs from what is staged
+if merge_head:
+    for filename in read_merge_conflicts():
+        if filename not in index_map:
+            continue
+        working_sha1 = file_sha1sum(filename) if os.path.isfile(filename) else None
+        if working_sha1 != index_map[filename]:
+            print(f"mygit-commit: error: '{filename}' has unresolved merge conflicts", file=sys.stderr)
+            sys.exit(1)
+        # The staged version is the working file, whose blob commit -a
+        # hasn't stored yet
+        with open(filename, "rb") as file:
+            if has_conflict_markers(file.read()):
+                print(f"mygit-commit: error: '{filename}' still has conflict markers", file=sys.stderr)
+                sys.exit(1)
 
 # Check for any staged changes
+# The index has the same files as the last commit exactly when their trees
+# have the same sha1, so the last commit's files don't need loading
 parent = int(last_commit) if last_commit else None
+parent_tree = commit_tree(last_commit)
+current_tree = tree_hash(current_files)
 if parent is None:
     if current_files:
         changed = True
 else:
-    previous_commit = os.path.join(objects_dir, f"{parent}.json")
-    with open(previous_commit, 'r') as parent_commit:
-        parent_data = json.load(parent_commit)
-    previous_commit_files = parent_data.get("files", {})
-    if current_files != previous_commit_files:
+    if current_tree != parent_tree or merge_head:
         changed = True
 
 # If no changes detected, don't commit
@@ -100,15 +144,19 @@ if not changed:
 # Get next commit number
 commit_num = next_commit_id(seq_file)
 
+# Store the trees of the index. Any subdirectory that didn't change
+# already has its tree stored, and is shared with the last commit
+write_tree(current_files)
+
 # Make a new blob file for any file that is changed
 # Copy file content into that blob content
-blobs_dir = os.path.join(objects_dir, "blobs")
-os.makedirs(blobs_dir, exist_ok=True)
-
-for file, sha1 in current_files.items():
-    blob_path = os.path.join(blobs_dir, sha1)
-    if not os.path.exists(blob_path) and os.path.exists(file):
-        shutil.copy2(file, blob_path)
+changed_files = (
+    {file: sha1 for file, _, sha1 in diff_trees(parent_tree, current_tree) if sha1 is not None}
+    if parent_tree is not None else current_files
+)
+for file, sha1 in changed_files.items():
+    if os.path.exists(file):
+        store_blob(file, sha1)
 
 # Timestamp for fun
 timestamp = datetime.now().isoformat(timespec='seconds')
@@ -120,18 +168,24 @@ new_commit = {
     "parent": None if last_commit == "" else parent,
     "message": commit_message,
     "timestamp": timestamp,
-    "files": current_files
+    "tree": current_tree
 }
+if merge_head:
+    new_commit["parent2"] = int(merge_head)
 
 # Create new commit JSON file
-commit_path = os.path.join(mygit, "objects", f"{commit_num}.json")
-with open(commit_path, "w") as file:
+new_commit_path = commit_path(commit_num)
+make_shard_dir(new_commit_path)
+with open(new_commit_path, "w") as file:
     json.dump(new_commit, file, indent=4)
+wrote_object(new_commit_path)
+update_commit_graph(commit_num)
 
 
 # Update branch pointer
-with open(branch_file, "w") as file:
-    file.write(str(commit_num))
+write_branch(branch, commit_num)
+if merge_head:
+    write_merge_head(None)
 
 # Change number in SEQ file
 bump_seq(seq_file, commit_num)
@@ -0,0 +1,37 @@
+#!/usr/bin/env python3
+
+import os
+import sys
+from helper import read_index, write_index, is_binary_index, lock_file, FileLocked
+
+# Convert a text index from an older repository to the binary format
+# Every command that writes the index writes the binary format anyway,
+# this just does it up front
+
+mygit = ".mygit"
+index_file = os.path.join(mygit, "index")
+
+if not os.path.isdir(mygit):
+    print("mygit-convert-index: error: mygit repository directory .mygit not found", file=sys.stderr)
+    sys.exit(1)
+
+if len(sys.argv) != 1:
+    print("usage: mygit-convert-index", file=sys.stderr)
+    sys.exit(1)
+
+if os.path.exists(index_file):
+    with open(index_file, "rb") as file:
+        if is_binary_index(file.read(4)):
+            print("Index is already binary")
+            sys.exit(0)
+
+# Lock the index before reading it, so nothing else changes it before
+# this command writes it back
+try:
+    lock_file(index_file)
+except FileLocked as error:
+    print(f"mygit-convert-index: error: {error}", file=sys.stderr)
+    sys.exit(1)
+index_map, index_stats = read_index(index_file)
+write_index(index_file, index_map, index_stats)
+print(f"Converted index with {len(index_map)} entries")
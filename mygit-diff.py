@@ -0,0 +1,157 @@
+#!/usr/bin/env python3
+
+import os
+import sys
+import re
+from helper import (
+    read_index, working_sha1s, read_blob, resolve_commit, current_branch, read_branch,
+    commit_tree, load_commit_files, diff_trees, split_lines, line_ids, diff_ranges
+)
+
+mygit = ".mygit"
+index_file = os.path.join(mygit, "index")
+context_check = re.compile(r'^-U([0-9]+)$')
+
+USAGE_MESSAGE = "usage: mygit-diff [-U<n>] [--cached [<commit>] | <commit> <commit>]"
+
+# Files with a NUL byte in this many bytes at the start are treated as binary
+BINARY_CHECK_SIZE = 8000
+
+if not os.path.isdir(mygit):
+    print("mygit-diff: error: mygit repository directory .mygit not found", file=sys.stderr)
+    sys.exit(1)
+
+
+context = 3
+cached = False
+commits = []
+for arg in sys.argv[1:]:
+    match = context_check.fullmatch(arg)
+    if match:
+        context = int(match.group(1))
+    elif arg == "--cached":
+        cached = True
+    elif arg.startswith("-"):
+        print(USAGE_MESSAGE, file=sys.stderr)
+        sys.exit(1)
+    else:
+        commits.append(arg)
+
+if len(commits) > (1 if cached else 2) or (not cached and len(commits) == 1):
+    print(USAGE_MESSAGE, file=sys.stderr)
+    sys.exit(1)
+
+
+def resolve(name):
+    commit_id = resolve_commit(name)
+    if commit_id is None:
+        print(f"mygit-diff: error: unknown commit '{name}'", file=sys.stderr)
+        sys.exit(1)
+    return commit_id
+
+
+# The files to diff as (path, old sha1, new sha1, read the new contents)
+# Only files whose sha1 differs are listed, so unchanged blobs are never read
+def changed_files():
+    if len(commits) == 2:
+        old, new = resolve(commits[0]), resolve(commits[1])
+        for path, old_sha1, new_sha1 in diff_trees(commit_tree(old), commit_tree(new)):
+            yield path, old_sha1, new_sha1, lambda sha1=new_sha1: read_blob(sha1)
+        return
+
+    index_map, index_stats = read_index(index_file) if os.path.exists(index_file) else ({}, {})
+    if cached:
+        commit_id = resolve(commits[0]) if commits else read_branch(current_branch())
+        commit_files = load_commit_files(commit_id)
+        for path in sorted(commit_files.keys() | index_map.keys()):
+            old_sha1, new_sha1 = commit_files.get(path), index_map.get(path)
+            if old_sha1 != new_sha1:
+                yield path, old_sha1, new_sha1, lambda sha1=new_sha1: read_blob(sha1)
+        return
+
+    # The stat data in the index means only files that changed get hashed
+    working_map = working_sha1s(sorted(index_map), index_map, index_stats, index_file)
+    for path in sorted(index_map):
+        new_sha1 = working_map.get(path)
+        if new_sha1 != index_map[path]:
+            yield path, index_map[path], new_sha1, lambda path=path: read_file(path)
+
+
+def read_file(path):
+    with open(path, "rb") as file:
+        return file.read()
+
+
+def format_range(start, end):
+    length = end - start
+    if length == 1:
+        return f"{start + 1}"
+    return f"{start + 1 if length else start},{length}"
+
+
+# Group changes that are close enough to share context into hunks
+def hunks(changes):
+    group = []
+    for change in changes:
+        if group and change[0] - group[-1][1] > 2 * context:
+            yield group
+            group = []
+        group.append(change)
+    if group:
+        yield group
+
+
+def write_lines(out, sign, lines):
+    for line in lines:
+        out.write(sign + line)
+        if not line.endswith(b"\n"):
+            out.write(b"\n\\ No newline at end of file\n")
+
+
+def write_diff(out, path, old_sha1, new_sha1, read_new):
+    old_name = f"a/{path}" if old_sha1 is not None else "/dev/null"
+    new_name = f"b/{path}" if new_sha1 is not None else "/dev/null"
+    out.write(f"diff --mygit a/{path} b/{path}\n".encode())
+    if old_sha1 is None:
+        out.write(b"new file\n")
+    elif new_sha1 is None:
+        out.write(b"deleted file\n")
+    out.write(f"index {old_sha1 or '0' * 40}..{new_sha1 or '0' * 40}\n".encode())
+
+    old_data = read_blob(old_sha1) if old_sha1 is not None else b""
+    new_data = read_new() if new_sha1 is not None else b""
+    if b"\0" in old_data[:BINARY_CHECK_SIZE] or b"\0" in new_data[:BINARY_CHECK_SIZE]:
+        out.write(f"Binary files {old_name} and {new_name} differ\n".encode())
+        return
+
+    old_lines, new_lines = split_lines(old_data), split_lines(new_data)
+    old_ids, new_ids = line_ids(old_lines, new_lines)
+    changes = diff_ranges(old_ids, new_ids)
+    if not changes:
+        return
+    out.write(f"--- {old_name}\n+++ {new_name}\n".encode())
+    for group in hunks(changes):
+        a_start = max(0, group[0][0] - context)
+        b_start = group[0][2] - (group[0][0] - a_start)
+        a_end = min(len(old_lines), group[-1][1] + context)
+        b_end = group[-1][3] + (a_end - group[-1][1])
+        out.write(f"@@ -{format_range(a_start, a_end)} +{format_range(b_start, b_end)} @@\n".encode())
+        a = a_start
+        for change_a_start, change_a_end, change_b_start, change_b_end in group:
+            write_lines(out, b" ", old_lines[a:change_a_start])
+            write_lines(out, b"-", old_lines[change_a_start:change_a_end])
+            write_lines(out, b"+", new_lines[change_b_start:change_b_end])
+            a = change_a_end
+        write_lines(out, b" ", old_lines[a:a_end])
+
+
+try:
+    out = sys.stdout.buffer
+    for path, old_sha1, new_sha1, read_new in changed_files():
+        write_diff(out, path, old_sha1, new_sha1, read_new)
+    out.flush()
+except BrokenPipeError:
+    # Whoever was reading stopped, e.g. head, so stop quietly
+    devnull = os.open(os.devnull, os.O_WRONLY)
+    os.dup2(devnull, sys.stdout.fileno())
+    sys.exit(1)
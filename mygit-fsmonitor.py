@@ -0,0 +1,344 @@
+#!/usr/bin/env python3
+
+import os
+import sys
+import time
+import struct
+from helper import (
+    fsmonitor_socket, get_config, FSMONITOR_TIMEOUT, VALID_NAME, ignore_file, ignore_patterns, is_ignored,
+    scan_working_files, forget_parsed
+)
+
+# A daemon that watches the working directory with inotify, so commands
+# can ask it what changed instead of scanning. See helper.py for how
+# commands use it
+#   mygit-fsmonitor start     start the daemon in the background
+#   mygit-fsmonitor stop      stop it
+#   mygit-fsmonitor status    say whether it's running
+#   mygit-fsmonitor run       run the daemon in the foreground
+#
+# Requests are one line, and the reply is one JSON object:
+#   query <token>   {"token": ..., "full": ..., "changed": [...], "files": [...]}
+#   quit            {"stopped": true}
+# Every directory the scan descends into is watched, so ignored directories
+# aren't. A change to .mygitignore means rescanning everything.
+# Tokens are "<instance>:<sequence>". Every event is labelled with the
+# sequence number current when it was read, and a query returns every file
+# labelled at or after the token's sequence. A token from another instance
+# of the daemon, or from before the kernel dropped events, gets "full": true,
+# meaning every file has to be checked
+
+mygit = ".mygit"
+# Anything the daemon prints goes here, since nothing is reading its stderr
+log_file = os.path.join(mygit, "fsmonitor.log")
+USAGE_MESSAGE = "usage: mygit-fsmonitor start|stop|status|run"
+
+# inotify flags, from <sys/inotify.h>
+IN_MODIFY = 0x2
+IN_ATTRIB = 0x4
+IN_CLOSE_WRITE = 0x8
+IN_MOVED_FROM = 0x40
+IN_MOVED_TO = 0x80
+IN_CREATE = 0x100
+IN_DELETE = 0x200
+IN_DELETE_SELF = 0x400
+IN_MOVE_SELF = 0x800
+IN_Q_OVERFLOW = 0x4000
+IN_IGNORED = 0x8000
+IN_ISDIR = 0x40000000
+WATCH_MASK = (
+    IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO
+    | IN_CREATE | IN_DELETE | IN_DELETE_SELF | IN_MOVE_SELF
+)
+INOTIFY_EVENT = struct.Struct("iIII")
+
+# Seconds to wait for a new daemon to start listening
+START_TIMEOUT = 5
+
+
+if not os.path.isdir(mygit):
+    print("mygit-fsmonitor: error: mygit repository directory .mygit not found", file=sys.stderr)
+    sys.exit(1)
+
+if len(sys.argv) != 2 or sys.argv[1] not in ("start", "stop", "status", "run"):
+    print(USAGE_MESSAGE, file=sys.stderr)
+    sys.exit(1)
+
+
+def load_libc():
+    import ctypes
+    import ctypes.util
+    libc = ctypes.CDLL(ctypes.util.find_library("c") or "libc.so.6", use_errno=True)
+    if not hasattr(libc, "inotify_init1"):
+        raise OSError("inotify is not available")
+    return libc
+
+
+# Returns the non-blocking inotify file descriptor
+def inotify_init(libc):
+    import ctypes
+    fd = libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+    if fd < 0:
+        raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+    return fd
+
+
+# Watch a directory, returning the watch descriptor or None if it's gone
+def inotify_watch(libc, fd, path):
+    import ctypes
+    wd = libc.inotify_add_watch(fd, (path or ".").encode(), WATCH_MASK)
+    if wd < 0:
+        error = ctypes.get_errno()
+        if path and error in (2, 20):  # ENOENT, ENOTDIR
+            return None
+        raise OSError(error, "inotify_add_watch failed")
+    return wd
+
+
+def is_regular_file(name):
+    try:
+        return os.path.isfile(name) and not os.path.islink(name)
+    except OSError:
+        return False
+
+
+def new_instance():
+    return f"{os.getpid()}-{time.time_ns()}"
+
+
+class Monitor:
+    def __init__(self, libc, fd):
+        self.libc = libc
+        self.fd = fd
+        self.instance = new_instance()
+        self.sequence = 1
+        self.changed_at = {}
+        self.watches = {}
+        self.watching = True
+        self.files = self.scan("")
+
+    # Watch a directory and everything under it, returning its files
+    # The watch goes on before the scan, so nothing created in between is missed
+    def scan(self, directory):
+        wd = inotify_watch(self.libc, self.fd, directory)
+        if wd is None:
+            return set()
+        self.watches[wd] = directory
+        dirs = []
+        files = scan_working_files(directory, dirs)
+        for path in dirs:
+            wd = inotify_watch(self.libc, self.fd, path)
+            if wd is not None:
+                self.watches[wd] = path
+        return files
+
+    # Start again from scratch, so no token we gave out can be trusted
+    # Directories that are ignored now stop being watched
+    def rescan(self):
+        for wd in self.watches:
+            self.libc.inotify_rm_watch(self.fd, wd)
+        self.watches.clear()
+        forget_parsed(ignore_file)
+        self.instance = new_instance()
+        self.changed_at.clear()
+        self.files = self.scan("")
+
+    # Read every event waiting in the kernel's queue
+    def read_events(self):
+        while True:
+            try:
+                data = os.read(self.fd, 1 << 16)
+            except BlockingIOError:
+                return
+            offset = 0
+            while offset < len(data):
+                wd, mask, _, length = INOTIFY_EVENT.unpack_from(data, offset)
+                offset += INOTIFY_EVENT.size
+                name = os.fsdecode(data[offset:offset + length].rstrip(b"\0"))
+                offset += length
+                self.handle_event(wd, mask, name)
+
+    def handle_event(self, wd, mask, name):
+        if mask & IN_Q_OVERFLOW:
+            # Events were lost
+            self.rescan()
+            return
+        directory = self.watches.get(wd)
+        if directory is None:
+            return
+        if mask & IN_IGNORED:
+            del self.watches[wd]
+        if mask & (IN_DELETE_SELF | IN_MOVE_SELF | IN_IGNORED):
+            # Only the working directory itself going away stops us, a
+            # subdirectory's files are dropped when its parent says it went
+            if directory == "":
+                self.watching = False
+            return
+        if directory == "" and name == ignore_file:
+            self.rescan()
+            return
+        if not VALID_NAME.fullmatch(name):
+            return
+        path = f"{directory}/{name}" if directory else name
+        if mask & IN_ISDIR:
+            self.handle_directory(mask, path)
+            return
+        if is_ignored(path, False, ignore_patterns()):
+            return
+        self.changed_at[path] = self.sequence
+        if mask & (IN_DELETE | IN_MOVED_FROM):
+            self.files.discard(path)
+        elif mask & (IN_CREATE | IN_MOVED_TO) and is_regular_file(path):
+            self.files.add(path)
+
+    # A directory appearing or going takes all of its files with it
+    def handle_directory(self, mask, path):
+        if mask & (IN_CREATE | IN_MOVED_TO):
+            if is_ignored(path, True, ignore_patterns()):
+                return
+            for file in self.scan(path):
+                self.files.add(file)
+                self.changed_at[file] = self.sequence
+        elif mask & (IN_DELETE | IN_MOVED_FROM):
+            prefix = path + "/"
+            for file in [file for file in self.files if file.startswith(prefix)]:
+                self.files.discard(file)
+                self.changed_at[file] = self.sequence
+            # A directory moved away keeps its watches, so forget them
+            for wd, directory in list(self.watches.items()):
+                if directory == path or directory.startswith(prefix):
+                    self.libc.inotify_rm_watch(self.fd, wd)
+                    del self.watches[wd]
+
+    def query(self, token):
+        # The kernel queues events as the changes happen, so reading the
+        # queue now catches every change made before the query was sent
+        self.read_events()
+        instance, _, sequence = token.partition(":")
+        full = instance != self.instance or not sequence.isdigit()
+        since = 0 if full else int(sequence)
+        changed = [name for name, at in self.changed_at.items() if at >= since]
+        self.sequence += 1
+        return {
+            "token": f"{self.instance}:{self.sequence}",
+            "full": full,
+            "changed": [] if full else changed,
+            "files": sorted(self.files),
+        }
+
+
+def serve():
+    import json
+    import select
+    import socket
+
+    try:
+        libc = load_libc()
+        fd = inotify_init(libc)
+        monitor = Monitor(libc, fd)
+    except (OSError, AttributeError) as error:
+        print(f"mygit-fsmonitor: error: can't watch the working directory: {error}", file=sys.stderr)
+        sys.exit(1)
+    idle_timeout = float(get_config("fsmonitor-idle", 600))
+
+    if os.path.exists(fsmonitor_socket):
+        os.remove(fsmonitor_socket)
+    server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    server.bind(fsmonitor_socket)
+    server.listen(16)
+    socket_inode = os.stat(fsmonitor_socket).st_ino
+
+    last_request = time.monotonic()
+    try:
+        while monitor.watching:
+            timeout = last_request + idle_timeout - time.monotonic()
+            if timeout <= 0:
+                break
+            readable, _, _ = select.select([fd, server], [], [], timeout)
+            if fd in readable:
+                monitor.read_events()
+            if server not in readable:
+                continue
+            last_request = time.monotonic()
+            client, _ = server.accept()
+            with client:
+                client.settimeout(FSMONITOR_TIMEOUT)
+                try:
+                    line = client.makefile("r").readline().strip()
+                    command, _, token = line.partition(" ")
+                    if command == "quit":
+                        client.sendall(b'{"stopped": true}\n')
+                        break
+                    if command == "query":
+                        client.sendall(json.dumps(monitor.query(token)).encode() + b"\n")
+                except OSError:
+                    continue
+    finally:
+        server.close()
+        os.close(fd)
+        # Only remove the socket if another daemon hasn't replaced it
+        try:
+            if os.stat(fsmonitor_socket).st_ino == socket_inode:
+                os.remove(fsmonitor_socket)
+        except FileNotFoundError:
+            pass
+
+
+# Send a request to a running daemon, or return None if there isn't one
+def request(line):
+    import socket
+    try:
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as client:
+            client.settimeout(FSMONITOR_TIMEOUT)
+            client.connect(fsmonitor_socket)
+            client.sendall(line.encode() + b"\n")
+            return client.makefile("r").readline()
+    except OSError:
+        return None
+
+action = sys.argv[1]
+
+if action == "run":
+    serve()
+    sys.exit(0)
+
+running = os.path.exists(fsmonitor_socket) and request("query") is not None
+
+if action == "status":
+    print("fsmonitor is running" if running else "fsmonitor is not running")
+    sys.exit(0)
+
+if action == "stop":
+    if not running:
+        print("mygit-fsmonitor: error: fsmonitor is not running", file=sys.stderr)
+        sys.exit(1)
+    request("quit")
+    print("Stopped fsmonitor")
+    sys.exit(0)
+
+if running:
+    print("mygit-fsmonitor: error: fsmonitor is already running", file=sys.stderr)
+    sys.exit(1)
+
+# Start the daemon in its own session, so it outlives this command
+# Its stderr is a log file rather than a pipe, which would fill up and
+# block it once this command stops reading
+import subprocess
+with open(os.devnull, "r+") as devnull, open(log_file, "w") as log:
+    daemon = subprocess.Popen(
+        [sys.executable, os.path.abspath(__file__), "run"],
+        stdin=devnull, stdout=devnull, stderr=log, start_new_session=True
+    )
+deadline = time.monotonic() + START_TIMEOUT
+while time.monotonic() < deadline:
+    if request("query") is not None:
+        print("Started fsmonitor")
+        sys.exit(0)
+    if daemon.poll() is not None:
+        with open(log_file, "r") as log:
+            message = log.read().strip()
+        print(message or "mygit-fsmonitor: error: fsmonitor exited", file=sys.stderr)
+        sys.exit(1)
+    time.sleep(0.05)
+print("mygit-fsmonitor: error: fsmonitor didn't start", file=sys.stderr)
+sys.exit(1)
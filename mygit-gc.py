@@ -0,0 +1,102 @@
+#!/usr/bin/env python3
+
+import os
+import sys
+import time
+from helper import (
+    reachable_objects, get_config, loose_blobs, loose_trees, loose_commits, loose_manifests,
+    load_packs, IDX_RECORD
+)
+
+# Delete objects nothing can reach any more
+# Everything reachable from a branch or the index is marked, and every
+# loose blob, tree and commit that isn't marked is deleted. Objects newer
+# than the grace period are kept even if unreachable, since a mygit-add or
+# mygit-commit running right now may have written them without having
+# written the index or branch that refers to them yet
+
+mygit = ".mygit"
+index_file = os.path.join(mygit, "index")
+USAGE_MESSAGE = "usage: mygit-gc [--dry-run] [--grace <minutes>]"
+
+if not os.path.isdir(mygit):
+    print("mygit-gc: error: mygit repository directory .mygit not found", file=sys.stderr)
+    sys.exit(1)
+
+dry_run = False
+grace = get_config("gc-grace", 60)
+args = sys.argv[1:]
+while args:
+    arg = args.pop(0)
+    if arg == "--dry-run":
+        dry_run = True
+    elif arg == "--grace" and args:
+        grace = args.pop(0)
+    elif arg.startswith("--grace="):
+        grace = arg[len("--grace="):]
+    else:
+        print(USAGE_MESSAGE, file=sys.stderr)
+        sys.exit(1)
+
+try:
+    grace = float(grace)
+except ValueError:
+    print(f"mygit-gc: error: invalid grace period '{grace}'", file=sys.stderr)
+    sys.exit(1)
+
+
+# Mark
+reachable_commits, reachable_trees, reachable_blobs, reachable_manifests = reachable_objects(index_file)
+
+
+# Sweep
+cutoff = time.time() - grace * 60
+removed = {"blobs": 0, "manifests": 0, "trees": 0, "commits": 0}
+reclaimed = 0
+recent = 0
+emptied_dirs = set()
+
+for kind, objects, reachable in (
+    ("blobs", loose_blobs(), reachable_blobs),
+    ("manifests", loose_manifests(), reachable_manifests),
+    ("trees", loose_trees(), reachable_trees),
+    ("commits", loose_commits(), reachable_commits),
+):
+    for name, path in list(objects):
+        if name in reachable:
+            continue
+        stat = os.stat(path)
+        if stat.st_mtime > cutoff:
+            recent += 1
+            continue
+        removed[kind] += 1
+        reclaimed += stat.st_size
+        if not dry_run:
+            os.remove(path)
+            emptied_dirs.add(os.path.dirname(path))
+
+# Remove shard directories left empty
+for directory in emptied_dirs:
+    if len(os.path.basename(directory)) == 2:
+        try:
+            os.rmdir(directory)
+        except OSError:
+            pass
+
+# Packed blobs are only dropped when mygit-repack rewrites the pack
+packed_unreachable = 0
+for _, records, count in load_packs():
+    for i in range(count):
+        if records[i * IDX_RECORD.size:i * IDX_RECORD.size + 20].hex() not in reachable_blobs:
+            packed_unreachable += 1
+
+
+print(f"Reachable: {len(reachable_commits)} commits, {len(reachable_trees)} trees, {len(reachable_blobs)} blobs")
+print(
+    f"{'Would remove' if dry_run else 'Removed'} {removed['commits']} commits, "
+    f"{removed['trees']} trees, {removed['blobs']} blobs, {removed['manifests']} manifests, {reclaimed} bytes"
+)
+if recent:
+    print(f"Kept {recent} unreachable objects newer than {grace:g} minutes")
+if packed_unreachable:
+    print(f"{packed_unreachable} unreachable blobs are in packs, mygit-repack will remove them")
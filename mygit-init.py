@@ -29,7 +29,8 @@ objects_path = os.path.join(mygit, objects)
 os.makedirs(objects_path, exist_ok=True)
 
 # Create a .mygit/objects/blobs directory to store all the files we commit
-# The files are named with the sha1sum of each file committed
+# The files are named with the sha1sum of each file committed, and kept in
+# subdirectories named by the first two characters of the sha1sum
 blobs_dir = os.path.join(objects_path, "blobs")
 os.makedirs(blobs_dir, exist_ok=True)
 
@@ -2,74 +2,129 @@
 
 import sys
 import os
-import re
-import json
+import heapq
 from datetime import datetime
+from helper import load_commit, current_branch, read_branch
 
 
 mygit = ".mygit"
 head_file = os.path.join(mygit, "HEAD")
 objects_dir = os.path.join(mygit, "objects")
 
+# Lines are flushed this often, so a reader like head gets them
+# without waiting for the whole history to be walked
+FLUSH_EVERY = 100
+
+USAGE_MESSAGE = "usage: mygit-log [-n <number>] [--since <date>] [--until <date>]"
+
 # Check if .mygit directory exists
 if not os.path.isdir(mygit):
     print("mygit-log: error: mygit repository directory .mygit not found", file=sys.stderr)
     sys.exit(1)
 
-# Regex to open commit files
-commit_file_pattern = re.compile(r'[0-9]+.json')
-
-# Get the current branch
-with open(head_file, "r") as hf:
-    head_content = hf.read().strip()
-curr_branch_path = head_content.replace("ref: ", "")
-curr_branch_file = os.path.join(mygit, curr_branch_path)
-
-# Get the latest commit on current branch
-with open(curr_branch_file, "r") as file:
-    branch_tip = file.read().strip()
-
-# Function for loading the commit file
-def load_commit(commit_id: str):
-    path = os.path.join(objects_dir, f"{commit_id}.json")
-    with open(path, "r") as file:
-        return json.load(file)
-
-# Timestamp for extra tight security on ordering commits
-# Global commit numbering does this as well but I put this here
-# for fun
-def parse(string):
-    return datetime.fromisoformat(string)
-
-# Travel through every commit like we are on a graph
-# Basically find the parent/parents of a commit
-# In a loop until we get to the first commit
-seen = set()
-stack = [branch_tip]
-collected_commits = []
-
-while stack:
-    commit_id = stack.pop()
-    if not commit_id or commit_id in seen:
-        continue
-    commit_file = load_commit((str(commit_id)))
-
-    collected_commits.append(commit_file)
-    seen.add(commit_id)
-
-    parent1 = commit_file.get("parent")
-    parent2 = commit_file.get("parent2")
-    if parent1 is not None and parent1 != "":
-        stack.append(str(parent1))
-    if parent2 is not None and parent2 != "":
-        stack.append(str(parent2))
-
-# This is to order the commits in reverse, so the most previous one comes first
-# It is also ordered on timestamp, which again I realise, at this point is for fun
-collected_commits.sort(
-    key=lambda c: (parse(c.get("timestamp", "")), int(c.get("commit_num", -1))),
-    reverse=True
-)
-
-for commit in collected_commits:
-    print(f"{commit.get('commit_num')} {commit.get('message', '')}")
\ No newline at end of file
+
+# Dates are compared as strings in the same format as commit timestamps,
+# which sorts the same as the dates themselves
+def parse_date(string):
+    try:
+        return datetime.fromisoformat(string).isoformat(timespec='seconds')
+    except ValueError:
+        print(f"mygit-log: error: invalid date '{string}'", file=sys.stderr)
+        sys.exit(1)
+
+
+def parse_count(string):
+    if not string.isdigit():
+        print(f"mygit-log: error: invalid number '{string}'", file=sys.stderr)
+        sys.exit(1)
+    return int(string)
+
+
+max_count = None
+since = None
+until = None
+args = sys.argv[1:]
+while args:
+    arg = args.pop(0)
+    name, equals, value = arg.partition("=")
+    if name in ("-n", "--since", "--until", "--max-count") and not equals:
+        if not args:
+            print(USAGE_MESSAGE, file=sys.stderr)
+            sys.exit(1)
+        value = args.pop(0)
+    elif arg.startswith("-n") and len(arg) > 2:
+        name, value = "-n", arg[2:]
+    elif not equals or name not in ("--since", "--until", "--max-count"):
+        print(USAGE_MESSAGE, file=sys.stderr)
+        sys.exit(1)
+
+    if name in ("-n", "--max-count"):
+        max_count = parse_count(value)
+    elif name == "--since":
+        since = parse_date(value)
+    else:
+        until = parse_date(value)
+
+
+# heapq pops the smallest item first, so this makes the newest the smallest
+class Newest:
+    __slots__ = ("key",)
+
+    def __init__(self, key):
+        self.key = key
+
+    def __lt__(self, other):
+        return self.key > other.key
+
+
+# Commits come out newest first, by timestamp and then commit number
+# Instead of loading every commit and sorting, the commits waiting to be
+# printed are kept in a heap, and a commit's parents are only loaded once
+# it has been printed. A parent is always older than its child, so the
+# newest commit in the heap is always the next one to print, and the walk
+# can stop as soon as we have printed enough
+def walk(tip):
+    seen = set()
+    heap = []
+
+    def push(commit_id):
+        if not commit_id or commit_id in seen:
+            return
+        seen.add(commit_id)
+        commit = load_commit(commit_id)
+        heapq.heappush(heap, (Newest((commit.timestamp, int(commit.id))), commit))
+
+    push(tip)
+    while heap:
+        _, commit = heapq.heappop(heap)
+        yield commit
+        for parent in commit.parents:
+            push(parent)
+
+
+def print_log():
+    printed = 0
+    for commit in walk(read_branch(current_branch())):
+        if max_count is not None and printed >= max_count:
+            break
+        timestamp = commit.timestamp
+        # Everything left is older than this
+        if since is not None and timestamp < since:
+            break
+        if until is not None and timestamp > until:
+            continue
+        print(f"{commit.id} {commit.message}")
+        printed += 1
+        if printed % FLUSH_EVERY == 0:
+            sys.stdout.flush()
+    sys.stdout.flush()
+
+
+try:
+    print_log()
+except BrokenPipeError:
+    # Whoever was reading stopped, e.g. head, so stop quietly. Anything
+    # still buffered for stdout is thrown away instead of raising again
+    devnull = os.open(os.devnull, os.O_WRONLY)
+    os.dup2(devnull, sys.stdout.fileno())
+    sys.exit(1)
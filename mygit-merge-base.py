@@ -0,0 +1,54 @@
+#!/usr/bin/env python3
+
+import os
+import sys
+from helper import resolve_commit, merge_bases
+
+USAGE_MESSAGE = "usage: mygit-merge-base [--all] (<branch|commit> <branch|commit> | --stdin)"
+
+mygit = ".mygit"
+if not os.path.isdir(mygit):
+    print("mygit-merge-base: error: mygit repository directory .mygit not found", file=sys.stderr)
+    sys.exit(1)
+
+args = sys.argv[1:]
+show_all = "--all" in args
+args = [arg for arg in args if arg != "--all"]
+
+
+def lookup(name):
+    commit_id = resolve_commit(name)
+    if commit_id is None:
+        print(f"mygit-merge-base: error: unknown commit '{name}'", file=sys.stderr)
+    return commit_id
+
+
+# With --stdin, each line has two branches or commits, and the merge bases
+# of each pair are printed on one line, best first, so many queries can be
+# answered by one process. Lines with no merge base are left empty
+if args == ["--stdin"]:
+    for line in sys.stdin:
+        names = line.split()
+        if len(names) != 2:
+            print(USAGE_MESSAGE, file=sys.stderr)
+            sys.exit(1)
+        one, two = lookup(names[0]), lookup(names[1])
+        if one is None or two is None:
+            sys.exit(1)
+        bases = merge_bases([one], [two])
+        print(" ".join(bases if show_all else bases[:1]), flush=True)
+    sys.exit(0)
+
+if len(args) != 2 or any(arg.startswith("-") for arg in args):
+    print(USAGE_MESSAGE, file=sys.stderr)
+    sys.exit(1)
+
+one, two = lookup(args[0]), lookup(args[1])
+if one is None or two is None:
+    sys.exit(1)
+
+bases = merge_bases([one], [two])
+if not bases:
+    sys.exit(1)
+for base in (bases if show_all else bases[:1]):
+    print(base)
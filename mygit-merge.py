@@ -4,8 +4,16 @@ import os
 import sys
 import re
 import json
+import hashlib
 from datetime import datetime
-from helper import file_sha1sum, read_seq, next_commit_id, bump_seq
+from helper import (
+    read_seq, next_commit_id, bump_seq, file_stat, read_index, write_index, working_sha1s,
+    write_blob_to, switch_files, report_switch, commit_path, commit_exists, make_shard_dir, update_commit_graph, wrote_object,
+    load_commit_files, merge_bases, merge_base_files, merge_file_maps,
+    branch_exists, current_branch, read_branch, write_branch,
+    commit_tree, tree_hash, write_tree, diff_trees, working_tree, remove_working_file, save_fsmonitor_token,
+    merge_blobs, write_data_to, store_blob, read_merge_head, write_merge_head, lock_file, FileLocked
+)
 
 mygit = ".mygit"
 branch_path = "refs/heads"
@@ -13,56 +21,18 @@ index_file = os.path.join(mygit, "index")
 objects_dir = os.path.join(mygit, "objects")
 branch_dir = os.path.join(mygit, branch_path)
 head_file = os.path.join(mygit, "HEAD")
-blobs_dir = os.path.join(objects_dir, "blobs")
 flag_check = re.compile(r'^-[0-9]+$')
 commit_num_check = re.compile(r'[0-9]+')
-valid_file = re.compile(r'^[a-zA-Z0-9][a-zA-Z0-9._-]*$')
 seq_file = os.path.join(mygit, "SEQ")
 
 
-def return_commit(commit_id: str):
-    commit_file = os.path.join(objects_dir, f"{commit_id}.json")
-    with open(commit_file, 'r') as commit:
-        commit_data = json.load(commit)
-    return commit_data.get("files", {})
-
-def safe_return_commit(commit_id):
-    if not commit_id:
-        return {}
-    return return_commit(commit_id)
-
-def load_parent(commit_id):
-    if commit_id is None or commit_id == "":
-        return None
-    commit_path = os.path.join(objects_dir, f"{commit_id}.json")
-    with open(commit_path, "r") as file:
-        parent = json.load(file).get("parent")
-    return None if parent is None else str(parent)
-
-def get_origin(current_commit_id, target_commit_id):
-    if current_commit_id == target_commit_id:
-        return current_commit_id
-    ancestors = set()
-    parent = current_commit_id
-    while parent is not None:
-        ancestors.add(parent)
-        parent = load_parent(parent)
-
-    parent_two = target_commit_id
-    while parent_two is not None:
-        if parent_two in ancestors:
-            return parent_two
-        parent_two = load_parent(parent_two)
-    return None
-
 if not os.path.isdir(mygit):
     print("mygit-merge: error: mygit repository directory .mygit not found", file=sys.stderr)
     sys.exit(1)
 
-with open(".mygit/refs/heads/trunk", "r") as file:
-    if not file.read().strip():
-        print("mygit-merge: error: this command can not be run until after the first commit", file=sys.stderr)
-        sys.exit(1)
+if not read_branch("trunk"):
+    print("mygit-merge: error: this command can not be run until after the first commit", file=sys.stderr)
+    sys.exit(1)
 
 args = sys.argv[1:]
 if not args:
@@ -100,40 +70,43 @@ elif args[1] == "-m":
     message = args[2]
 
 
-with open(head_file, "r") as file:
-    head_content = file.read().strip() 
-current_branch_path = head_content.replace("ref: ", "")
-current_branch = os.path.join(mygit, current_branch_path)
+if read_merge_head():
+    print("mygit-merge: error: a merge with conflicts has not been committed yet", file=sys.stderr)
+    sys.exit(1)
 
-with open(current_branch, "r") as file:
-    current_commit_id = file.read().strip()
+branch = current_branch()
+current_commit_id = read_branch(branch)
 
 target_commit_id = None
 if commit_num_check.fullmatch(merge_target):
-    commit_file = os.path.join(objects_dir, f"{merge_target}.json")
-    if not os.path.exists(commit_file):
+    if not commit_exists(merge_target):
         print(f"mygit-merge: error: unknown commit '{merge_target}'", file=sys.stderr)
         sys.exit(1)
     target_commit_id = merge_target
 else:
-    branch_file = os.path.join(branch_dir, merge_target)
-    if not os.path.exists(branch_file):
+    if not branch_exists(merge_target):
         print(f"mygit-merge: error: unknown branch '{merge_target}'", file=sys.stderr)
         sys.exit(1)
-    with open(branch_file, "r") as file:
-        target_commit_id = file.read().strip()
+    target_commit_id = read_branch(merge_target)
 
 if target_commit_id == current_commit_id:
     print("Already up to date")
     sys.exit(0)
 
-with open(index_file, "r") as file:
-    index_entries = [line.strip().split(None, 1) for line in file if line.strip()]
-index_map = {filename: sha1 for filename, sha1 in index_entries} if index_entries else {}
+# Lock the index before reading it, so nothing else changes it before
+# this command writes it back
+try:
+    lock_file(index_file)
+except FileLocked as error:
+    print(f"mygit-merge: error: {error}", file=sys.stderr)
+    sys.exit(1)
+index_map, index_stats = read_index(index_file)
 
-current_commit_files = safe_return_commit(current_commit_id)
+current_commit_files = load_commit_files(current_commit_id)
+current_tree = commit_tree(current_commit_id)
 
-diff_index_current_commit = sorted(
+# The index matches the current commit exactly when their trees are the same
+diff_index_current_commit = [] if tree_hash(index_map) == current_tree else sorted(
         file for file in (set(index_map) | set(current_commit_files))
         if index_map.get(file) != current_commit_files.get(file)
 )
@@ -144,15 +117,15 @@ if diff_index_current_commit:
         print(file)
     sys.exit(1)
 
-working_files = sorted(
-    file for file in os.listdir('.')
-    if os.path.isfile(file) and valid_file.fullmatch(file)
+# The fsmonitor, if it's running, knows the files and which changed
+working_files, changed, monitor_token = working_tree(index_map)
+working_map = working_sha1s(
+    [file for file in index_map if file in working_files],
+    index_map, index_stats, index_file, changed
 )
-def sha1(file): 
-    return file_sha1sum(file) if os.path.exists(file) else None
 tracked_dirty = sorted(
     file for file in index_map.keys()
-    if (file in working_files and sha1(file) != index_map[file]) or (file not in working_files)
+    if (file in working_files and working_map.get(file) != index_map[file]) or (file not in working_files)
 )
 
 if tracked_dirty:
@@ -162,112 +135,115 @@ if tracked_dirty:
     sys.exit(1)
 
 
-target_commit_files = safe_return_commit(target_commit_id)
-origin_commit_id = get_origin(current_commit_id, target_commit_id)
+target_commit_files = load_commit_files(target_commit_id)
+target_tree = commit_tree(target_commit_id)
 
-if origin_commit_id == current_commit_id:
-    prev_set = set(current_commit_files.keys())
-    target_set = set(target_commit_files.keys())
+# Following both parents of merge commits from both sides
+bases = merge_bases([current_commit_id], [target_commit_id])
 
-    for file in sorted(prev_set - target_set):
-        if valid_file.fullmatch(file) and os.path.exists(file):
-            os.remove(file)
-    
-    for file, sha1 in sorted(target_commit_files.items()):
-        blob_path = os.path.join(blobs_dir, sha1)
-        with open(blob_path, "rb") as src, open(file, "wb") as dst:
-            dst.write(src.read())
-    
-    tmp = index_file + ".tmp"
-    with open(tmp, "w") as file:
-        for name, sha1 in sorted(target_commit_files.items()):
-            file.write(f"{name} {sha1}\n")
-    os.replace(tmp, index_file)
-
-    with open(head_file, "r") as hf:
-        head_content = hf.read().strip()
-    curr_branch_path = head_content.replace("ref: ", "")
-    curr_branch_file = os.path.join(mygit, curr_branch_path)
-    with open(curr_branch_file, "w") as bf:
-        bf.write(target_commit_id)
+if current_commit_id in bases:
+    # Only the files that differ between the two commits are written
+    target_stats, written, removed = switch_files(current_commit_id, target_commit_id, index_stats)
+
+    write_index(index_file, target_commit_files, target_stats)
+    if monitor_token is not None:
+        save_fsmonitor_token(monitor_token)
+
+    write_branch(branch, target_commit_id)
 
     print("Fast-forward: no commit created")
+    report_switch(written, removed)
     sys.exit(0)
 
 
-if origin_commit_id == target_commit_id:
+if target_commit_id in bases:
     print("Already up to date")
     sys.exit(0)
 
 
-origin_files = safe_return_commit(origin_commit_id)
-C = current_commit_files
-T = target_commit_files
-O = origin_files
-all_paths = sorted(set(C)| set(T)| set(O))
-
-conflict = set()
-merged = {}
-
-# Decision function to decide which files on which branch to take
-def decide(o, c, t):
-    if c == t:
-        return ("delete", None) if c is None else ("ok", c)
-    if o is not None:
-        if c == o and t != o:
-            return ("ok", t)
-        if c != o and t == o:
-            return ("ok", c)
-        if c is None and t == o:
-            return ("delete", None)
-        if t is None and c == o:
-            return ("delete", None)
-        return ("conflict", None)
+# With more than one merge base, they are merged into a virtual origin
+origin_files = merge_base_files(bases)
+# Only files that differ between the two trees need deciding, and
+# subdirectories that are the same on both sides are skipped entirely
+changed = {file for file, _, _ in diff_trees(current_tree, target_tree)}
+merged, conflict = merge_file_maps(origin_files, current_commit_files, target_commit_files, changed)
+
+# Files both sides changed are merged line by line. Only these blobs are
+# ever read, every other file was decided from its sha1s alone. A file
+# one side deleted, or a binary file, can't be merged this way
+contents = {}
+unmergeable = []
+for file in sorted(conflict):
+    current_sha1 = current_commit_files.get(file)
+    target_sha1 = target_commit_files.get(file)
+    if current_sha1 is None or target_sha1 is None:
+        unmergeable.append(file)
+        continue
+    # A file that conflicted between several merge bases has no one origin
+    origin_sha1 = origin_files.get(file)
+    if origin_sha1 == "conflict":
+        origin_sha1 = None
+    result = merge_blobs(origin_sha1, current_sha1, target_sha1, (branch, merge_target))
+    if result is None:
+        unmergeable.append(file)
     else:
-        if c is None and t is None:
-            return ("delete", None)
-        if c is None and t is not None:
-            return ("ok", t)
-        if t is None and c is not None:
-            return ("ok", c)
-        return ("conflict", None)
-
-for file in all_paths:
-    c = C.get(file)
-    t = T.get(file)
-    o = O.get(file)
-
-    status, branch = decide(o, c, t)
-    if status == "ok" and branch is not None:
-        merged[file] = branch
-    elif status == "delete":
-        pass
-    elif status == "conflict":
-        conflict.add(file)
-
-if conflict:
+        contents[file] = result
+
+if unmergeable:
     print("mygit-merge: error: These files can not be merged:")
-    for file in conflict:
+    for file in unmergeable:
         print(file)
     sys.exit(1)
 
 
-# Delete any files that are not in merge
-delete_files = (set(C) | set(T)) - set(merged.keys())
+# Delete any files that are not in merge. Files merged line by line are
+# written over the working file below, which keeps its mode
+delete_files = (set(current_commit_files) | set(target_commit_files)) - set(merged.keys()) - set(contents)
+removed = 0
 for file in sorted(delete_files):
-    if valid_file.fullmatch(file) and os.path.exists(file):
-        os.remove(file)
-
+    if os.path.exists(file):
+        remove_working_file(file)
+        removed += 1
+
+# Files that are the same as in the current commit are already in the
+# working directory, so only the ones the merge changed are written
+merged_stats = {}
+written = 0
 for file, sha1 in sorted(merged.items()):
-    blob_path = os.path.join(blobs_dir, sha1)
-    with open(blob_path, "rb") as src, open(file, "wb") as dst:
-        dst.write(src.read())
-
-tmp = index_file + ".tmp"
-with open(tmp, "w") as file:
-    for name, sha1 in sorted(merged.items()):
-        file.write(f"{name} {sha1}\n")
-os.replace(tmp, index_file)
+    if sha1 == current_commit_files.get(file) and os.path.exists(file):
+        if file in index_stats:
+            merged_stats[file] = index_stats[file]
+        continue
+    write_blob_to(sha1, file)
+    merged_stats[file] = file_stat(file)
+    written += 1
+
+# Files merged cleanly are staged like any other. Files with conflicts
+# keep the current commit's version in the index until they're fixed
+conflicted = []
+for file, (data, conflicts) in sorted(contents.items()):
+    write_data_to(data, file)
+    written += 1
+    if conflicts:
+        merged[file] = current_commit_files[file]
+        conflicted.append(file)
+        continue
+    merged[file] = hashlib.sha1(data).hexdigest()
+    merged_stats[file] = file_stat(file)
+    store_blob(file, merged[file])
+
+write_index(index_file, merged, merged_stats)
+if monitor_token is not None:
+    save_fsmonitor_token(monitor_token)
+
+# The merge commit is made by mygit-commit once the conflicts are fixed
+if conflicted:
+    write_merge_head(target_commit_id, conflicted)
+    for file in conflicted:
+        print(f"CONFLICT (content): Merge conflict in {file}")
+    print("Automatic merge failed; fix conflicts and then commit the result.")
+    report_switch(written, removed)
+    sys.exit(1)
 
 merge_commit_id = str(next_commit_id(seq_file))
 
@@ -279,18 +255,21 @@ new_commit = {
     "parent2": int(target_commit_id),
     "message": message,
     "timestamp": timestamp,
-    "files": merged,
+    "tree": write_tree(merged),
 }
-commit_path = os.path.join(mygit, "objects", f"{merge_commit_id}.json")
-with open(commit_path, "w") as file:
+merge_commit_path = commit_path(merge_commit_id)
+make_shard_dir(merge_commit_path)
+with open(merge_commit_path, "w") as file:
     json.dump(new_commit, file, indent=4)
+wrote_object(merge_commit_path)
+update_commit_graph(merge_commit_id)
 
-with open(current_branch, "w") as file:
-    file.write(merge_commit_id)
+write_branch(branch, merge_commit_id)
 
 bump_seq(seq_file, merge_commit_id)
 
 print(f"Committed as commit {merge_commit_id}")
+report_switch(written, removed)
 sys.exit(0)
 
 
@@ -0,0 +1,41 @@
+#!/usr/bin/env python3
+
+import os
+import sys
+from helper import (
+    branch_dir, packed_refs_file, lock_file, forget_parsed, read_packed_refs, write_packed_refs,
+    read_branch, write_ref, FileLocked
+)
+
+# Move every branch in .mygit/refs/heads into .mygit/packed-refs, so
+# listing branches reads one file instead of one per branch. Branches
+# keep working the same, see helper.py. The branch files are only removed
+# after packed-refs is written, so a crash never loses a branch
+
+mygit = ".mygit"
+
+if not os.path.isdir(mygit):
+    print("mygit-pack-refs: error: mygit repository directory .mygit not found", file=sys.stderr)
+    sys.exit(1)
+
+if len(sys.argv) != 1:
+    print("usage: mygit-pack-refs", file=sys.stderr)
+    sys.exit(1)
+
+try:
+    lock_file(packed_refs_file)
+except FileLocked as error:
+    print(f"mygit-pack-refs: error: {error}", file=sys.stderr)
+    sys.exit(1)
+
+forget_parsed(packed_refs_file)
+branches = read_packed_refs()
+loose = sorted(os.listdir(branch_dir))
+for branch in loose:
+    branches[branch] = read_branch(branch)
+
+write_packed_refs(branches)
+for branch in loose:
+    write_ref(os.path.join(branch_dir, branch), None)
+
+print(f"Packed {len(loose)} branches, {len(branches)} branches in packed-refs")
@@ -0,0 +1,171 @@
+#!/usr/bin/env python3
+
+import os
+import sys
+import zlib
+import hashlib
+import time
+from helper import (
+    pack_dir, reachable_objects, loose_blobs, commit_exists, load_commit_files, get_config, read_seq, read_index,
+    read_blob, load_packs, reset_packs, make_delta, wrote_object, flush_objects, MAX_DELTA_DEPTH,
+    PACK_HEADER, PACK_ENTRY, IDX_HEADER, IDX_RECORD, PACK_FULL, PACK_DELTA
+)
+
+mygit = ".mygit"
+index_file = os.path.join(mygit, "index")
+seq_file = os.path.join(mygit, "SEQ")
+
+if not os.path.isdir(mygit):
+    print("mygit-repack: error: mygit repository directory .mygit not found", file=sys.stderr)
+    sys.exit(1)
+
+if len(sys.argv) != 1:
+    print("usage: mygit-repack", file=sys.stderr)
+    sys.exit(1)
+
+# Pack entries are inflated in memory when read, so really big blobs
+# stay loose where they can be copied without loading them
+max_blob_size = int(get_config("pack-max-blob-size", 64 * 1024 * 1024))
+
+
+# Every blob we have, loose or already in a pack
+loose_paths = dict(loose_blobs())
+loose_sizes = {sha1: os.path.getsize(path) for sha1, path in loose_paths.items()}
+
+# Packed blobs nothing can reach are dropped from the new pack. Loose ones
+# are left for mygit-gc, and so are the blobs of packs newer than its grace
+# period, since a mygit-add running right now may not have written the
+# index that refers to them yet
+grace = get_config("gc-grace", 60)
+try:
+    cutoff = time.time() - float(grace) * 60
+except ValueError:
+    print(f"mygit-repack: error: invalid grace period '{grace}'", file=sys.stderr)
+    sys.exit(1)
+reachable_blobs = reachable_objects(index_file)[2]
+
+old_packs = [pack_path for pack_path, _, _ in load_packs()]
+packed_blobs = set()
+dropped = 0
+for pack_path, records, count in load_packs():
+    recent = os.path.getmtime(pack_path) > cutoff
+    for i in range(count):
+        sha1 = records[i * IDX_RECORD.size:i * IDX_RECORD.size + 20].hex()
+        if recent or sha1 in reachable_blobs:
+            packed_blobs.add(sha1)
+        else:
+            dropped += 1
+
+to_pack = {sha1 for sha1, size in loose_sizes.items() if size <= max_blob_size} | packed_blobs
+if not to_pack and not old_packs:
+    print("Nothing to pack")
+    sys.exit(0)
+
+
+# Pick a delta base for each blob by walking history from newest to oldest
+# The newest version of a file is stored in full and each older version
+# is a delta against the next newer version of the same file. Bases are
+# always blobs seen earlier in the walk, so there can't be any cycles
+def snapshots():
+    index_map, _ = read_index(index_file)
+    yield index_map
+    for commit_id in range(read_seq(seq_file), -1, -1):
+        if commit_exists(commit_id):
+            yield load_commit_files(commit_id)
+
+order = []
+seen = set()
+delta_base = {}
+depth = {}
+newer = {}
+for files in snapshots():
+    for filename, sha1 in files.items():
+        if sha1 in to_pack and sha1 not in seen:
+            seen.add(sha1)
+            order.append(sha1)
+            depth[sha1] = 0
+            base = newer.get(filename)
+            if base is not None and depth[base] < MAX_DELTA_DEPTH:
+                delta_base[sha1] = base
+                depth[sha1] = depth[base] + 1
+        if sha1 in to_pack:
+            newer[filename] = sha1
+order.extend(sorted(to_pack - seen))
+
+
+# Write the pack, hashing it as we go to get the trailer and the pack name
+os.makedirs(pack_dir, exist_ok=True)
+tmp_pack = os.path.join(pack_dir, "tmp_pack")
+offsets = {}
+deltas = 0
+pack_hash = hashlib.sha1()
+with open(tmp_pack, "wb") as pack:
+    def write(data):
+        pack_hash.update(data)
+        pack.write(data)
+
+    write(PACK_HEADER.pack(b"MPCK", 1, len(order)))
+    position = PACK_HEADER.size
+    for sha1 in order:
+        data = read_blob(sha1)
+        body = zlib.compress(data)
+
+        # Only keep the delta if it is smaller than the compressed blob
+        base = delta_base.get(sha1)
+        if base is not None:
+            delta = zlib.compress(make_delta(read_blob(base), data))
+            if len(delta) + 20 < len(body):
+                body = delta
+                deltas += 1
+            else:
+                base = None
+
+        if base is None:
+            header = PACK_ENTRY.pack(PACK_FULL, len(body))
+        else:
+            header = PACK_ENTRY.pack(PACK_DELTA, len(body)) + bytes.fromhex(base)
+        offsets[sha1] = position
+        write(header)
+        write(body)
+        position += len(header) + len(body)
+
+    checksum = pack_hash.digest()
+    pack.write(checksum)
+
+pack_name = f"pack-{checksum.hex()}"
+pack_path = os.path.join(pack_dir, pack_name + ".pack")
+os.replace(tmp_pack, pack_path)
+wrote_object(pack_path)
+
+# Write the index last, because a pack is only used once its index exists
+tmp_idx = os.path.join(pack_dir, "tmp_idx")
+with open(tmp_idx, "wb") as idx:
+    idx.write(IDX_HEADER.pack(b"MIDX", 1, len(offsets)))
+    for sha1 in sorted(offsets):
+        idx.write(IDX_RECORD.pack(bytes.fromhex(sha1), offsets[sha1]))
+    idx.write(checksum)
+os.replace(tmp_idx, os.path.join(pack_dir, pack_name + ".idx"))
+wrote_object(os.path.join(pack_dir, pack_name + ".idx"))
+reset_packs()
+
+# With durability set, the new pack has to be on disk before we delete
+# anything it replaces
+flush_objects()
+
+
+# Everything is in the new pack now, so remove old packs and packed loose blobs
+for old_pack in old_packs:
+    if old_pack != pack_path:
+        os.remove(old_pack[:-5] + ".idx")
+        os.remove(old_pack)
+
+before = 0
+for sha1, size in loose_sizes.items():
+    if sha1 in offsets:
+        before += size
+        os.remove(loose_paths[sha1])
+
+print(f"Packed {len(order)} blobs ({deltas} as deltas) into {pack_name}.pack")
+if dropped:
+    print(f"Dropped {dropped} unreachable packed blobs")
+print(f"{before} bytes of loose blobs packed into {os.path.getsize(pack_path)} bytes")
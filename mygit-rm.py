@@ -2,8 +2,7 @@
 import os
 import sys
 import re
-import json
-from helper import file_sha1sum
+from helper import open_index, save_index, FileLocked, valid_path, remove_working_file, working_sha1s, commit_exists, load_commit_files, current_branch, read_branch
 
 USAGE_MESSAGE = "usage: mygit-rm [--force] [--cached] <filenames>"
 
@@ -11,7 +10,6 @@ USAGE_MESSAGE = "usage: mygit-rm [--force] [--cached] <filenames>"
 mygit = ".mygit"
 index_file = os.path.join(mygit, "index")
 objects_dir = os.path.join(mygit, "objects")
-blobs_dir = ".mygit/objects/blobs"
 
 if not os.path.isdir(mygit):
     print("mygit-rm: error: mygit repository directory .mygit not found", file=sys.stderr)
@@ -19,7 +17,6 @@ if not os.path.isdir(mygit):
 
 args = sys.argv[1:]
 
-valid_file = re.compile(r'^[a-zA-Z0-9][a-zA-Z0-9._-]*$')
 flags_allowed = ["--", "--force", "--cached"]
 flag_check = re.compile(r'^[-]+[^\s]+$')
 
@@ -112,31 +109,18 @@ else:
 if not os.path.exists(index_file):
     open(index_file, "w").close()
 
-with open(index_file, "r") as file:
-    index_entries = [line.strip().split(None, 1) for line in file if line.strip()]
-index_map = {fname: sha1 for fname, sha1 in index_entries}
-
-
-# Get current branch
-
-head_file = os.path.join(mygit, "HEAD")
-with open(head_file, "r") as file:
-    head_content = file.read().strip()
+try:
+    index_map, index_stats = open_index(index_file)
+except FileLocked as error:
+    print(f"mygit-rm: error: {error}", file=sys.stderr)
+    sys.exit(1)
 
-branch_path = head_content.replace("ref: ", "")
-branch_file = os.path.join(".mygit", branch_path)
 
-# Get the previous commit
-last_commit = None
+# Get the previous commit on the current branch
+last_commit = read_branch(current_branch())
 previous_commit_files = {}
-if os.path.exists(branch_file):
-    with open(branch_file, "r") as file:
-        last_commit = file.read().strip()
-    if last_commit:
-        commit_file = os.path.join(objects_dir, f"{last_commit}.json")
-        if os.path.exists(commit_file):
-            with open(commit_file, "r") as file:
-                previous_commit_files = json.load(file).get("files", {})
+if last_commit and commit_exists(last_commit):
+    previous_commit_files = load_commit_files(last_commit)
 
 
 # Check for any files not in the repository 
@@ -151,13 +135,17 @@ for file in filenames:
 # Or if there are changes that still need to be committed
 # If --cached, then we only care about if index != working file and index != repo (according to last commit)
 # If --force, ignore any warnings and just remove anyways
+working_map = {} if force else working_sha1s(
+    [file for file in filenames if valid_path(file)],
+    index_map, index_stats, index_file
+)
 for file in filenames:
-    if not valid_file.fullmatch(file):
+    if not valid_path(file):
         print(f"mygit-rm: error: invalid filename '{file}'", file=sys.stderr)
         sys.exit(1)
     sha1 = index_map[file]
     working_exists = os.path.exists(file)
-    working_hash = file_sha1sum(file) if working_exists else None
+    working_hash = working_map.get(file)
 
     if force:
         if cached:
@@ -165,7 +153,7 @@ for file in filenames:
         else:
             del index_map[file]
             if working_exists:
-                os.remove(file)
+                remove_working_file(file)
         continue
 
     if cached:
@@ -189,11 +177,13 @@ for file in filenames:
         sys.exit(1)
     del index_map[file]
     if working_exists:
-        os.remove(file)
+        remove_working_file(file)
 
-with open(index_file, "w") as file:
-    for fname, sha1 in index_map.items():
-        file.write(f"{fname} {sha1}\n")
+try:
+    save_index(index_file, index_map, index_stats)
+except FileLocked as error:
+    print(f"mygit-rm: error: {error}", file=sys.stderr)
+    sys.exit(1)
    
     
 
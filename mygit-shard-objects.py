@@ -0,0 +1,44 @@
+#!/usr/bin/env python3
+
+import os
+import sys
+import re
+from helper import objects_dir, blobs_dir, blob_path, commit_shard, shard_path, make_shard_dir
+
+# Move the objects of a repository made before sharding into their
+# two hex character subdirectories. Safe to run more than once, and
+# safe to interrupt, since every move is a single rename
+
+mygit = ".mygit"
+blob_pattern = re.compile(r'^[0-9a-f]{40}$')
+commit_pattern = re.compile(r'^([0-9]+)\.json$')
+
+if not os.path.isdir(mygit):
+    print("mygit-shard-objects: error: mygit repository directory .mygit not found", file=sys.stderr)
+    sys.exit(1)
+
+if len(sys.argv) != 1:
+    print("usage: mygit-shard-objects", file=sys.stderr)
+    sys.exit(1)
+
+moved_blobs = 0
+if os.path.isdir(blobs_dir):
+    for name in os.listdir(blobs_dir):
+        path = os.path.join(blobs_dir, name)
+        if blob_pattern.fullmatch(name) and os.path.isfile(path):
+            new_path = blob_path(name)
+            make_shard_dir(new_path)
+            os.replace(path, new_path)
+            moved_blobs += 1
+
+moved_commits = 0
+for name in os.listdir(objects_dir):
+    match = commit_pattern.fullmatch(name)
+    path = os.path.join(objects_dir, name)
+    if match and os.path.isfile(path):
+        new_path = shard_path(objects_dir, name, commit_shard(match.group(1)))
+        make_shard_dir(new_path)
+        os.replace(path, new_path)
+        moved_commits += 1
+
+print(f"Moved {moved_blobs} blobs and {moved_commits} commits into shard directories")
@@ -3,7 +3,7 @@
 import os
 import sys
 import re
-import json
+from helper import index_lookup, send_blob, blob_exists, commit_path, commit_tree, tree_lookup, valid_path
 
 # Standard existing repo check
 mygit = ".mygit"
@@ -12,18 +12,62 @@ if not os.path.isdir(mygit):
     sys.exit(1)
 
 
-# Define how the command should go
+index_file = os.path.join(mygit, "index")
 show_file_pattern = re.compile(r'^[^:]*:[^:]+$')
+commit_pattern = re.compile(r'[0-9]*')
+
+
+# Whoever was reading stopped, e.g. head, so stop quietly. Anything
+# still buffered for stdout is thrown away instead of raising again
+def stop_quietly():
+    devnull = os.open(os.devnull, os.O_WRONLY)
+    os.dup2(devnull, sys.stdout.fileno())
+    sys.exit(1)
+
+
+# Batch mode reads one <commit>:<filename> per line of stdin and writes
+#   <sha1> <size>\n<contents>\n    for each file found
+#   <commit>:<filename> missing\n  for anything else
+# Each commit's tree is only read once however many of its files are asked for
+def show_batch():
+    out = sys.stdout.buffer
+    trees = {}
+    for line in sys.stdin:
+        spec = line.rstrip("\n")
+        commit, _, filename = spec.partition(":")
+        blob_hash = None
+        if show_file_pattern.fullmatch(spec) and commit_pattern.fullmatch(commit):
+            if commit == "":
+                blob_hash = index_lookup(index_file, filename)
+            else:
+                if commit not in trees:
+                    trees[commit] = commit_tree(commit) if os.path.exists(commit_path(commit)) else None
+                if trees[commit] is not None:
+                    blob_hash = tree_lookup(trees[commit], filename)
+        if blob_hash is None or not blob_exists(blob_hash):
+            out.write(f"{spec} missing\n".encode())
+            continue
+        send_blob(blob_hash, out, lambda size: f"{blob_hash} {size}\n".encode())
+        out.write(b"\n")
+    out.flush()
+
+
+# Define how the command should go
+if sys.argv[1:] == ["--batch"]:
+    try:
+        show_batch()
+    except BrokenPipeError:
+        stop_quietly()
+    sys.exit(0)
+
 if len(sys.argv) != 2 or not show_file_pattern.fullmatch(sys.argv[1]):
-    print("usage: mygit-show <commit>:<filename>", file=sys.stderr)
+    print("usage: mygit-show <commit>:<filename>\n       mygit-show --batch", file=sys.stderr)
     sys.exit(1)
 
 arg = sys.argv[1]
 commit = arg.split(":")[0]
 filename = arg.split(":")[1]
 
-commit_pattern = re.compile(r'[0-9]*')
-
 # Check for invalid commits
 if not commit_pattern.fullmatch(commit):
     print(f"mygit-show: error: unknown commit '{commit}'", file=sys.stderr)
@@ -33,53 +77,46 @@ if not commit_pattern.fullmatch(commit):
 # Get the specified commit file
 commit_file = None
 if commit != "":
-    commit_file = os.path.join(mygit, "objects", f"{commit}.json")
+    commit_file = commit_path(commit)
     if not os.path.exists(commit_file):
         print(f"mygit-show: error: unknown commit '{commit}'", file=sys.stderr)
         sys.exit(1)
 
-file_pattern = re.compile(r'^[a-zA-Z0-9][a-zA-Z0-9._-]*$')
-if not file_pattern.fullmatch(filename):
+if not valid_path(filename):
     print(f"mygit-show: error: invalid filename '{filename}", file=sys.stderr)
     sys.exit(1)
 
 # If no commit specified, we show the file of the most previous commit as per the index 
 if commit == "":
-    index_file = os.path.join(mygit, "index")
-    with open(index_file, "r") as file:
-        index_entries = [line.strip().split(" ") for line in file if line.strip()]
-    index_map = {fname: sha1 for fname, sha1 in index_entries}
+    blob_hash = index_lookup(index_file, filename)
 
-    if filename not in index_map:
+    if blob_hash is None:
         print(f"mygit-show: error: '{filename}' not found in index", file=sys.stderr)
         sys.exit(1)
     
-    blob_hash = index_map[filename]
-    blob_path = os.path.join(mygit, "objects", "blobs", blob_hash)
-
-    with open(blob_path, "r") as blob_file:
-        print(blob_file.read(), end="")
+    try:
+        send_blob(blob_hash, sys.stdout.buffer)
+        sys.stdout.flush()
+    except BrokenPipeError:
+        stop_quietly()
     sys.exit(0)
 
-# Open commit file and get all files listed in commit file
-with open(commit_file, "r") as file:
-    commit_data = json.load(file)
-
-map_file = commit_data.get("files", {})
-if filename not in map_file:
+# Look the file up in the commit's tree
+blob_hash = tree_lookup(commit_tree(commit), filename)
+if blob_hash is None:
     print(f"mygit-show: error: '{filename}' not found in commit {commit}", file=sys.stderr)
     sys.exit(1)
 
-blob_hash = map_file[filename]
-
 # If the blob doesn't exist (which is unlikely) then just exit
-blob_path = os.path.join(mygit, "objects", "blobs", blob_hash)
-if not os.path.exists(blob_path):
+if not blob_exists(blob_hash):
     sys.exit(1)
 
-# Print file stored in the blobs directory
-with open(blob_path, "r") as blob_file:
-    print(blob_file.read(), end="")
+# Copy the file stored in the blobs directory or in a pack to stdout
+try:
+    send_blob(blob_hash, sys.stdout.buffer)
+    sys.stdout.flush()
+except BrokenPipeError:
+    stop_quietly()
 
 
 
@@ -2,9 +2,10 @@
 
 import os
 import sys
-import json
-import re
-from helper import file_sha1sum
+from helper import (
+    open_index, save_index, FileLocked, working_sha1s, commit_exists, load_commit_files, current_branch, read_branch,
+    working_tree, save_fsmonitor_token
+)
 
 mygit = ".mygit"
 index_file = os.path.join(mygit, "index")
@@ -14,49 +15,53 @@ if not os.path.isdir(mygit):
     print("mygit-status: error: mygit repository directory .mygit not found", file=sys.stderr)
     sys.exit(1)
 
-valid_file = re.compile(r'^[a-zA-Z0-9][a-zA-Z0-9._-]*$')
-
-working_files = sorted(
-    file for file in os.listdir('.')
-    if os.path.isfile(file) and valid_file.fullmatch(file)
-)
-
 if not os.path.exists(index_file):
     open(index_file, "w").close()
 
-with open(index_file, "r") as file:
-    index_entries = [line.strip().split(None, 1) for line in file if line.strip()]
-
-index_map = {filename: sha1 for filename, sha1 in index_entries} if index_entries else {}
-
-head_file = os.path.join(mygit, "HEAD")
-with open(head_file, "r") as file:
-    head_content = file.read().strip()
-
-branch_path = head_content.replace("ref: ", "")
-branch_file = os.path.join(".mygit", branch_path)
+try:
+    index_map, index_stats = open_index(index_file)
+except FileLocked as error:
+    print(f"mygit-status: error: {error}", file=sys.stderr)
+    sys.exit(1)
 
+# A set, so checking if a file is in the working directory is O(1)
+# If the fsmonitor is running it already knows the files, and which of
+# them changed since the last time we asked
+working_files, changed, monitor_token = working_tree(index_map)
 
 previous_commit_files = {}
-if os.path.exists(branch_file):
-    with open(branch_file, "r") as file:
-        last_commit = file.read().strip()
-    if last_commit:
-        commit_file = os.path.join(objects_dir, f"{last_commit}.json")
-        if os.path.exists(commit_file):
-            with open(commit_file, "r") as file:
-                previous_commit_files = json.load(file).get("files", {})
+last_commit = read_branch(current_branch())
+if last_commit and commit_exists(last_commit):
+    previous_commit_files = load_commit_files(last_commit)
 
 
 # Create a sorted set that combines working files, files in index and files in commit
-all_files = sorted(set(working_files) | set(index_map) | set(previous_commit_files))
+all_files = sorted(working_files | set(index_map) | set(previous_commit_files))
+
+# Only files in both the index and the working directory need their sha1,
+# and the stat data in the index lets us skip hashing unchanged ones
+old_stats = dict(index_stats)
+working_map = working_sha1s(
+    [file for file in index_map if file in working_files],
+    index_map, index_stats, index_file, changed
+)
+
+# Save any refreshed stat data so the next status doesn't re-hash those files
+if index_stats != old_stats:
+    try:
+        save_index(index_file, index_map, index_stats)
+    except FileLocked as error:
+        print(f"mygit-status: error: {error}", file=sys.stderr)
+        sys.exit(1)
+if monitor_token is not None:
+    save_fsmonitor_token(monitor_token)
 
 for file in all_files:
     in_working = file in working_files
     in_index = file in index_map
     in_commit = file in previous_commit_files
 
-    working_sha1 = file_sha1sum(file) if in_working else None
+    working_sha1 = working_map.get(file)
     index_sha1 = index_map.get(file)
     commit_sha1 = previous_commit_files.get(file)
 
@@ -0,0 +1,114 @@
+#!/usr/bin/env python3
+
+import os
+import sys
+
+# One entry point for every command:
+#   mygit <command> [args]    runs mygit-<command>.py with args
+#   mygit batch               runs one command per line of stdin
+#   mygit --trace <file> ...  traces every command run, see helper.py
+#
+# Only the script for the command being run is loaded, so a command pays
+# for its own imports and nothing else. In batch mode every command runs
+# in this one process, so the interpreter starts once and the index, HEAD,
+# refs and other files parsed by helper.py are reused by later commands
+# for as long as they haven't changed.
+#
+# Each command in a batch writes exactly what it would write on its own,
+# followed on stdout by a line holding a NUL byte and its exit status,
+# so a reader can tell where each command's output ends.
+
+script_dir = os.path.dirname(os.path.abspath(__file__))
+USAGE_MESSAGE = "usage: mygit [--trace <file>] <command> [<args>]\n       mygit [--trace <file>] batch"
+
+_compiled = {}
+
+
+def script_path(command):
+    if not command or command.startswith("-") or "/" in command or command == "batch":
+        return None
+    path = os.path.join(script_dir, f"mygit-{command}.py")
+    return path if os.path.isfile(path) else None
+
+
+# Run one command in this process and return its exit status
+def run_command(command, args):
+    path = script_path(command)
+    if path is None:
+        print(f"mygit: error: unknown command '{command}'", file=sys.stderr)
+        return 1
+
+    # Scripts are only compiled once per process
+    code = _compiled.get(path)
+    if code is None:
+        with open(path, "r") as file:
+            code = compile(file.read(), path, "exec")
+        _compiled[path] = code
+
+    if script_dir not in sys.path:
+        sys.path.insert(0, script_dir)
+    sys.argv = [f"mygit-{command}", *args]
+    status = 0
+    try:
+        # A bad setting stops this command, not the whole batch
+        helper = sys.modules.get("helper")
+        if helper is not None:
+            helper.start_command()
+        exec(code, {"__name__": "__main__", "__file__": path})
+    except SystemExit as exit:
+        if exit.code is None:
+            status = 0
+        elif isinstance(exit.code, int):
+            status = exit.code
+        else:
+            print(exit.code, file=sys.stderr)
+            status = 1
+    except Exception:
+        # Same as the traceback and exit status of a crashed script
+        import traceback
+        traceback.print_exc()
+        status = 1
+    # The first command to run imports helper
+    helper = sys.modules.get("helper")
+    if helper is not None:
+        helper.end_transaction()
+        helper.end_command(status)
+    return status
+
+
+def run_batch():
+    import io
+    import shlex
+    commands = sys.stdin
+    for line in commands:
+        words = shlex.split(line)
+        if not words:
+            continue
+        # Commands in a batch don't get to read the rest of the batch
+        sys.stdin = io.StringIO("")
+        try:
+            status = run_command(words[0], words[1:])
+        finally:
+            sys.stdin = commands
+        sys.stderr.flush()
+        sys.stdout.write(f"\0{status}\n")
+        sys.stdout.flush()
+    return 0
+
+
+# --trace <file> is the same as setting MYGIT_TRACE
+if len(sys.argv) >= 3 and sys.argv[1] == "--trace":
+    os.environ["MYGIT_TRACE"] = sys.argv[2]
+    del sys.argv[1:3]
+
+if len(sys.argv) < 2:
+    print(USAGE_MESSAGE, file=sys.stderr)
+    sys.exit(1)
+
+if sys.argv[1] == "batch":
+    if len(sys.argv) != 2:
+        print(USAGE_MESSAGE, file=sys.stderr)
+        sys.exit(1)
+    sys.exit(run_batch())
+
+sys.exit(run_command(sys.argv[1], sys.argv[2:]))